@@ -4,6 +4,7 @@ import requests   # See: http://docs.python-requests.org/en/master/
 from pprint import pprint
 import logging
 import sys
+import threading
 
 logging.getLogger('urllib3').setLevel(logging.INFO) # Don't want this debug level to cloud ours
 
@@ -59,9 +60,14 @@ class IMatchAPI:
     COLLECTION_PINS_BLUE = 53
     COLLECTION_PINS_NONE = 54
     REQUEST_TIMEOUT = 10                    # Request timeout in seconds
+    ATTRIBUTE_BATCH_SIZE = 500              # Files per request when reading attributes in bulk
+    MAX_CONCURRENT_REQUESTS = 4             # Requests in flight to IMatch at once, across all platforms
 
     __auth_token = None # This stores the IMWS authentication token after authenticate() has been called
     __host_url = None
+    __session = requests.Session()          # One connection pool shared by every platform
+    __session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=MAX_CONCURRENT_REQUESTS))
+    __requests = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
     collection_values = {
         COLLECTION_FLAGS : "Flags",
         COLLECTION_FLAGS_SET : "Flags|Set",
@@ -95,11 +101,12 @@ class IMatchAPI:
 
             try:
                 print(f"IMatchAPI: Attempting connection to IMatch on port {host_port}")
-                req = requests.post(IMatchAPI.__host_url + '/v1/authenticate', params={
-                    'id': os.getlogin(),
-                    'password': '',
-                    'appid': ''},
-                    timeout=IMatchAPI.REQUEST_TIMEOUT)
+                with IMatchAPI.__requests:
+                    req = IMatchAPI.__session.post(IMatchAPI.__host_url + '/v1/authenticate', params={
+                        'id': os.getlogin(),
+                        'password': '',
+                        'appid': ''},
+                        timeout=IMatchAPI.REQUEST_TIMEOUT)
 
                 response = json.loads(req.text)
 
@@ -134,7 +141,8 @@ class IMatchAPI:
             endpoint = "/" + endpoint
 
         try:
-            req = requests.get(cls.__host_url + endpoint, params, timeout=cls.REQUEST_TIMEOUT)
+            with cls.__requests:
+                req = cls.__session.get(cls.__host_url + endpoint, params=params, timeout=cls.REQUEST_TIMEOUT)
             response = json.loads(req.text)
             if req.status_code == requests.codes.ok:
                 return response
@@ -157,7 +165,8 @@ class IMatchAPI:
         if endpoint[:1] != "/":
             endpoint = "/" + endpoint
 
-        req = requests.post(cls.__host_url + endpoint, params, timeout=cls.REQUEST_TIMEOUT)
+        with cls.__requests:
+            req = cls.__session.post(cls.__host_url + endpoint, params, timeout=cls.REQUEST_TIMEOUT)
         response = json.loads(req.text)
         if req.status_code == requests.codes.ok:
             return response
@@ -187,9 +196,10 @@ class IMatchAPI:
             sys.exit(1)
 
     @classmethod
-    def delete_attributes(cls, set, filelist, params={}, data={}):
+    def delete_attributes(cls, set, filelist, params=None, data={}):
         """ Delete attributes for image with id. Assumes attributes only exist once.
          (modification required if multiple instances of attribute sets are to be managed) """
+        params = {} if params is None else dict(params)
 
         params['set'] = set
         params['id'] = IMatchUtility().prepare_filelist(filelist)
@@ -222,8 +232,9 @@ class IMatchAPI:
         return response['value']
 
     @classmethod
-    def get_attributes(cls, set, id, params={}):
+    def get_attributes(cls, set, id, params=None):
         """ Return all attributes for a list of file ids. filelist is an array. """
+        params = {} if params is None else dict(params)
 
         params['set'] = set
         params['id'] = IMatchUtility().prepare_filelist(id)
@@ -239,8 +250,26 @@ class IMatchAPI:
         return results
 
     @classmethod
-    def get_category_info(cls, category, params={}):
+    def get_attributed_files(cls, set, filelist):
+        """ Return {file id : attributes} for the files in filelist that have an instance of the attribute set.
+         Files are requested in batches so large lists don't overflow the request. """
+
+        results = {}
+        for start in range(0, len(filelist), cls.ATTRIBUTE_BATCH_SIZE):
+            params = {}
+            params['set'] = set
+            params['id'] = IMatchUtility().prepare_filelist(filelist[start:start + cls.ATTRIBUTE_BATCH_SIZE])
+            response = cls.get_imatch( '/v1/attributes', params)
+            for attributes in response['result']:
+                if len(attributes['data']) > 0:
+                    results[attributes['id']] = attributes['data'][0]
+        logging.debug(f"{len(results)} of {len(filelist)} files have {set} attributes.")
+        return results
+
+    @classmethod
+    def get_category_info(cls, category, params=None):
         """ Return information about a category"""
+        params = {} if params is None else dict(params)
 
         params['path'] = category
         
@@ -249,8 +278,9 @@ class IMatchAPI:
         return response['categories']
 
     @classmethod
-    def get_file_categories(cls, filelist, params={}):
+    def get_file_categories(cls, filelist, params=None):
         """ Return the categories for the list of files """
+        params = {} if params is None else dict(params)
 
         params['id'] = IMatchUtility().prepare_filelist(filelist)
 
@@ -289,12 +319,12 @@ class IMatchAPI:
 
 
     @classmethod
-    def get_categories_children(cls, path):
+    def get_categories_children(cls, path, fields='children,files,path'):
         """ Return the requested information all child categories the specified category """
 
         params={}
         params['path'] = path
-        params['fields'] = 'children,files,path'
+        params['fields'] = fields
 
         logging.debug(f'Retrieving list of children categories in the {path} category.')
         response = cls.get_imatch( '/v1/categories', params)
@@ -308,8 +338,9 @@ class IMatchAPI:
 
 
     @classmethod
-    def get_file_metadata(cls, filelist, params={}):
+    def get_file_metadata(cls, filelist, params=None):
         """ Return details list of file ids """
+        params = {} if params is None else dict(params)
 
         params['id'] = IMatchUtility().prepare_filelist(filelist)
         response = cls.get_imatch( '/v1/files', params)
@@ -361,9 +392,10 @@ class IMatchAPI:
             print(ex)
 
     @classmethod
-    def set_attributes(cls, set, filelist, params={}, data={}):
+    def set_attributes(cls, set, filelist, params=None, data={}):
         """ Set attributes for image with id. Assumes attributes only exist once. Will either add or update as needed.
          (modification required if multiple instances of attribute sets are to be managed) """
+        params = {} if params is None else dict(params)
 
         params['set'] = set
         params['id'] = IMatchUtility().prepare_filelist(filelist)
@@ -403,8 +435,9 @@ class IMatchAPI:
             sys.exit()
 
     @classmethod
-    def set_collections(cls, collection, filelist, op="add", params={}):
+    def set_collections(cls, collection, filelist, op="add", params=None):
         """ Set collections for files."""
+        params = {} if params is None else dict(params)
         if isinstance(collection, int):
             path = cls.collection_values[collection]
         else:
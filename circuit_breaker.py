@@ -0,0 +1,22 @@
+class CircuitBreaker():
+    """Track consecutive failures against a platform and open once it looks to be down.
+
+    While open, the controller stops sending requests for the rest of the run and leaves what is
+    left for the next one. Any success closes it again."""
+
+    def __init__(self, name, threshold) -> None:
+        self.name = name
+        self.threshold = threshold
+        self.failures = 0
+
+    @property
+    def is_open(self) -> bool:
+        return self.failures >= self.threshold
+
+    def record_success(self):
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures == self.threshold:
+            print(f"{self.name}: {self.failures} operations failed in a row. Leaving {self.name} alone for the rest of this run.")
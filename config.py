@@ -1,3 +1,5 @@
+import os
+
 # Root socials category
 ROOT_CATEGORY = "Socials"
 
@@ -9,5 +11,120 @@ DELETE_CATEGORY = "_delete"
 # Error category root. All error categories sit below this
 ERROR_CATEGORY = "__errors"
 
+# Root of the IMatch event categories, e.g. Event|Festival|...
+EVENT_CATEGORY = "Event"
+
 # Standardise reference to Megabyte
-MB_SIZE = 1048576
\ No newline at end of file
+MB_SIZE = 1048576
+
+# Local state (caches, queues) kept between runs. Sits alongside the scripts.
+STATE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "state")
+
+# Persistent cache of read-only platform API responses. Entries expire after
+# the number of seconds given for their method and the oldest are dropped
+# once the cache holds more than CACHE_MAX_ENTRIES per platform.
+CACHE_MAX_ENTRIES = 5000
+CACHE_TTL = {
+    'photos.getInfo' : 7 * 24 * 3600,
+    'photos.getAllContexts' : 7 * 24 * 3600,
+    'status_source' : 24 * 3600,
+}
+
+# Seconds to leave a flickr group alone after it says the photo limit has been reached
+FLICKR_GROUP_THROTTLE_RETRY = 24 * 3600
+
+# Mastodon API media uploads. Files upload in parallel, then the server is polled every
+# MEDIA_POLL_INTERVAL seconds (backing off) until it has finished processing each one.
+MEDIA_UPLOAD_WORKERS = 4
+MEDIA_POLL_INTERVAL = 1.0
+MEDIA_PROCESSING_TIMEOUT = 600
+
+# Optional pre-upload transcoding. A platform listed here uploads a derivative no larger than
+# max_dimension pixels on the long edge and max_bytes in size, instead of the original file.
+# Derivatives are rendered in TRANSCODE_WORKERS processes and cached in the state folder.
+TRANSCODE_PROFILES = {
+    'mastodon' : {'max_dimension' : 3840, 'max_bytes' : 8 * MB_SIZE, 'format' : "JPEG", 'quality' : 90},
+    'pixelfed' : {'max_dimension' : 2048, 'max_bytes' : 4 * MB_SIZE, 'format' : "JPEG", 'quality' : 90},
+}
+TRANSCODE_WORKERS = os.cpu_count()
+TRANSCODE_CACHE_DAYS = 30
+
+# Files uploaded to more than one platform in a run are read from disk once and shared from memory,
+# holding up to SOURCE_BUFFER_MAX_BYTES at a time.
+SOURCE_BUFFER_MAX_BYTES = 1024 * MB_SIZE
+
+# Seconds a run may spend working through fediverse deletions, including waits for the
+# delete rate limit. Deletions not started in time are left for the next run.
+DELETE_TIME_BUDGET = 15 * 60
+
+# Servers speaking the Mastodon API. Each is a platform of its own, with IMatch categories under
+# Socials|{name} and application variables {name}_url, {name}_token and {name}_visibility.
+FEDIVERSE_INSTANCES = ["mastodon", "pixelfed"]
+
+# Platforms left out of a run unless named on the command line
+SKIPPED_BY_DEFAULT = ["mastodon", "pixelfed"]   # currently bugged at server end
+
+# Failed platform operations are retried up to RETRY_ATTEMPTS times in a run, waiting
+# RETRY_BASE_DELAY seconds before the first retry and doubling the wait each time. After
+# CIRCUIT_BREAKER_THRESHOLD failures in a row a platform is left alone until the next run.
+# Images still failing are assigned to the PLATFORM_ERROR error category and retried next run.
+RETRY_ATTEMPTS = 3
+RETRY_BASE_DELAY = 5
+CIRCUIT_BREAKER_THRESHOLD = 5
+PLATFORM_ERROR = "platform error"
+
+# Fediverse instances that post several images as one status, e.g. {'pixelfed' : "day"}. "day"
+# groups images taken on the same day, "event" groups images in the same category below
+# EVENT_CATEGORY. Each status holds up to the server's media attachment limit, or
+# FEDIVERSE_MEDIA_LIMIT if the server does not say. Instances not listed post each image alone.
+FEDIVERSE_GROUPING = {}
+FEDIVERSE_MEDIA_LIMIT = 4
+
+# Processes used to render quantum masters and thumbnails before they are written to the site.
+# Can be overridden with --workers.
+RENDITION_WORKERS = os.cpu_count()
+
+# Rendered quantum images are kept in the state folder, keyed by source and settings, and published
+# to the site as hard links. Ones no longer on the site are removed after RENDITION_CACHE_DAYS.
+RENDITION_CACHE_DAYS = 30
+
+# Compile quantum templates again whenever they change on disk, while working on them
+TEMPLATE_RELOAD = False
+
+# Responsive renditions written for each quantum photo alongside its JPEG master and WebP thumbnail,
+# in every format listed here that the installed Pillow can write. Widths larger than the source are
+# skipped. Pages list them in srcset_{format} fields for the site to offer the best fit.
+QUANTUM_PHOTO_WIDTHS = [480, 800, 1200, 1600]
+QUANTUM_THUMBNAIL_WIDTHS = [150, 300]
+QUANTUM_RENDITION_FORMATS = {
+    "AVIF" : {'quality' : 55},
+    "WEBP" : {'quality' : 80},
+}
+
+# Largest file, in bytes, written for a quantum master and thumbnail. Quality is lowered from the
+# configured setting until the file fits. Responsive renditions get the master's budget scaled to
+# their area.
+QUANTUM_MASTER_MAX_BYTES = 400 * 1024
+QUANTUM_THUMBNAIL_MAX_BYTES = 20 * 1024
+
+# Quantum's map.json clusters geotagged photos for zoom levels 0 to QUANTUM_MAP_MAX_ZOOM, in a grid
+# of QUANTUM_MAP_GRID cells across each side of a map tile. Closer in, the site uses index.json.
+QUANTUM_MAP_MAX_ZOOM = 14
+QUANTUM_MAP_GRID = 4
+
+# Used by --plan to project how long a run would take. Each call is assumed to take PLAN_CALL_SECONDS
+# and uploads to go at PLAN_UPLOAD_RATE bytes a second. A platform listed in PLAN_RATE_LIMITS allows
+# at most calls requests per window seconds, and in PLAN_DELETE_LIMITS at most that many deletions.
+# Quantum renders each image in about PLAN_RENDER_SECONDS on each of RENDITION_WORKERS processes.
+PLAN_CALL_SECONDS = 0.5
+PLAN_UPLOAD_RATE = 2 * MB_SIZE
+PLAN_RENDER_SECONDS = 2
+PLAN_RATE_LIMITS = {
+    'flickr' : {'calls' : 3600, 'window' : 3600},
+    'mastodon' : {'calls' : 300, 'window' : 300},
+    'pixelfed' : {'calls' : 300, 'window' : 300},
+}
+PLAN_DELETE_LIMITS = {
+    'mastodon' : {'calls' : 30, 'window' : 1800},
+    'pixelfed' : {'calls' : 30, 'window' : 1800},
+}
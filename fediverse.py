@@ -0,0 +1,474 @@
+## Pre-requisites
+# pip3 install Mastodon.py
+#
+# One engine for every server speaking the Mastodon API (Mastodon, Pixelfed, ...). Each instance is a
+# platform of its own, named in config.FEDIVERSE_INSTANCES, with its connection details held in the
+# IMatch application variables {name}_url, {name}_token and {name}_visibility.
+from collections import Counter
+import sys
+import logging
+import time
+
+import requests
+
+from imatch_image import IMatchImage
+from journal import OperationJournal
+from media_pipeline import MediaPipeline, post_media
+from platform_base import CommitError, PlatformController, format_duration
+import IMatchAPI as im
+import config
+
+mastodon = None     # Imported by connect() so runs with nothing to upload skip the import
+
+class FediverseImage(IMatchImage):
+
+    __MAX_SIZE = 15 * config.MB_SIZE
+
+    def __init__(self, id, platform) -> None:
+        super().__init__(id, platform)
+        self.alt_text = None
+        self.media = None   # Media already uploaded for this image, if any
+
+    def prepare_for_upload(self) -> None:
+        """Build variables ready for uploading."""
+        super().prepare_for_upload()
+
+        # Remove spaces from keywords
+        self.keywords = [item.replace(" ","") for item in self.keywords]
+        self.keywords = [item.replace("-","") for item in self.keywords]
+        self.keywords.append("photography")
+
+        if self.circadatecreated != "":
+            circa = "ca. "
+        else:
+            circa = ""
+        tmp_description = [f"{self.title} -- {self.headline} (Taken {circa}{self.date_time.strftime("%#d %B %Y")})"]
+        tmp_description.append('')
+        if len(self.keywords) > 0:
+            tmp_description.append(" ".join(["#" + keyword for keyword in self.keywords]))  # Ensure keywords are hashtags
+            tmp_description.append('')
+
+        shooting_info = self.shooting_info
+        if shooting_info != '':
+            tmp_description.append(shooting_info)
+        
+        camera_info = self.camera_info
+        if camera_info != '':
+            tmp_description.append(camera_info)
+
+        self.full_description = "\n".join(tmp_description)
+        return None
+
+    @property
+    def is_valid(self) -> bool:
+        result = super().is_valid
+        for attribute in []:
+            try:
+                if getattr(self, attribute).strip() == '':
+                    self.errors.append(f"missing {attribute}")
+            except AttributeError:
+                self.errors.append(f"missing {attribute}")
+        if self.size > FediverseImage.__MAX_SIZE and self.controller.transcode_profile is None:
+            self.errors.append(f"file too large")
+        return len(self.errors) == 0 and result
+
+    @property
+    def is_on_platform(self) -> bool:
+        res = im.IMatchAPI.get_attributes(self.controller.name, self.id)
+        return len(res) != 0
+
+class FediverseController(PlatformController):
+    
+    def __init__(self, platform) -> None:
+        super().__init__(platform)
+        self.upload_format = im.IMatchAPI.FORMAT_JPEG
+        self._delete_deadline = None    # Set when the first deletion of the run is paced
+        self.grouping = config.FEDIVERSE_GROUPING.get(platform)    # None posts each image on its own
+        self.media_limit = config.FEDIVERSE_MEDIA_LIMIT
+        self.uploads_on_update = False  # commit_update only edits the media description and status
+        self._status_members = None     # Status id -> {image id : media id}, read from IMatch on first use
+
+    def connect(self):
+        global mastodon
+        if self.api is not None:
+            return
+        else:
+            import mastodon
+
+            # Create a Mastodon instance. Get secrets from IMatch
+            # https://www.photools.com/help/imatch/index.html#var_basics.htm
+            try:
+                print(f"{self.name}: Work to do -- Connecting to platform.")
+                access_token = im.IMatchAPI.get_application_variable(f"{self.name}_token")
+                if access_token == "":
+                    raise ValueError(f"{self.name}_token in empty")
+                api_base_url = im.IMatchAPI.get_application_variable(f"{self.name}_url")
+                if api_base_url == "":
+                    raise ValueError(f"{self.name}_url token in empty")   
+
+                # Each instance gets its own connection pool, sized for the upload workers. Requests go
+                # out as fast as they are made and Mastodon.py only waits if the rate limit runs out.
+                # Deletions, with their much smaller limit, are spread out by pace_delete().
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_maxsize=config.MEDIA_UPLOAD_WORKERS)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                server = mastodon.Mastodon(
+                    access_token = access_token,
+                    api_base_url = api_base_url,
+                    ratelimit_method = "wait",
+                    session = session
+                )
+            except ValueError as e:
+                logging.error(f"{self.name}: Account connection error. {e}")
+                sys.exit(1)
+            except mastodon.MastodonUnauthorizedError:
+                logging.error(f"{self.name} unauthorised for connection.")
+                sys.exit(1)
+
+            # Fetch my account details. Serves as a good check of connection details
+            # before bothering to upload images. If it fails here, nothing else will work.
+            try:
+                print(f"{self.name}: Verifying account credentials.")
+                account = server.account_verify_credentials()
+                print(f"{self.name}: Verified. Connected to {account['url']}.")
+            except mastodon.MastodonNetworkError as mne:
+                logging.error(f"{self.name}: Unable to obtain account details. Check URL {im.IMatchAPI.get_application_variable(f"{self.name}_url")}.")
+                logging.error(mne)
+                sys.exit(1)
+            except mastodon.MastodonAPIError as me:
+                logging.error(f"{self.name}: Unable to access credentials. Check token.")
+                logging.error(me)
+                sys.exit(1)
+            except Exception as e:
+                logging.error(f"{self.name}: An unexpected error occurred: {e}")
+                sys.exit(1)
+
+            ## Get the default visibility for posts. Can be one of:
+            # public = Visible to everyone, shown in public timelines.
+            # unlisted = Visible to public, but not included in public timelines.
+            # private = Visible to followers only, and to any mentioned users.
+            # direct = Visible only to mentioned users.
+
+            self._visibility = im.IMatchAPI.get_application_variable(f"{self.name}_visibility")
+
+            if self.grouping is not None:
+                try:
+                    self.media_limit = server.instance()['configuration']['statuses']['max_media_attachments']
+                except (KeyError, TypeError, mastodon.MastodonError):
+                    pass    # Older servers don't say, so keep the default
+            self.api = server
+
+    def fetch_status_source(self, status_id):
+        """Return the editable source of a status, using the response cache where possible"""
+        return self.cache.fetch('status_source', status_id,
+            lambda: dict(self.api.status_source(status_id))
+            )
+
+    def group_key(self, image):
+        """Return what an image is grouped by when posting, or None to post it on its own"""
+        match self.grouping:
+            case "day":
+                return image.date_time.date()
+            case "event":
+                for category in image.categories:
+                    if category['path'].startswith(config.EVENT_CATEGORY + "|"):
+                        return category['path']
+        return None
+
+    def group_images(self, images):
+        """Split images into the groups posted together, each in date order"""
+        if self.grouping is None:
+            return [[image] for image in images]
+        groups = {}
+        for image in sorted(images, key=lambda image: image.date_time):
+            groups.setdefault(self.group_key(image), []).append(image)
+        result = []
+        for key, members in groups.items():
+            if key is None:
+                result.extend([image] for image in members)
+            else:
+                result.extend(members[start:start + self.media_limit] for start in range(0, len(members), self.media_limit))
+        return result
+
+    def group_description(self, images):
+        """Status text for several images posted together"""
+        lines = [image.full_description.split("\n")[0] for image in images]
+        keywords = []
+        for image in images:
+            keywords.extend(keyword for keyword in image.keywords if keyword not in keywords)
+        lines.append('')
+        lines.append(" ".join(["#" + keyword for keyword in keywords]))
+        return "\n".join(lines)
+
+    def status_members(self, status_id):
+        """Return {image id : media id} for every image attached to a status"""
+        if self._status_members is None:
+            self._status_members = {}
+            for image_id, attributes in im.IMatchAPI.get_attributed_files(self.name, self.catalog_ids).items():
+                self._status_members.setdefault(str(attributes.get('status_id')), {})[image_id] = attributes.get('media_id')
+        return self._status_members.setdefault(str(status_id), {})
+
+    def add_images(self):
+        """Upload media for all images together and post each status as soon as the media for it is ready.
+        Instances with a grouping rule post each group as one status."""
+        if len(self.images_to_add) == 0 or self.testing:
+            return super().add_images()
+
+        self.connect()
+
+        pipeline = MediaPipeline(self.api)
+        for image in self.images_to_add:
+            image.prepare_for_upload()
+        self.transcode_images(self.images_to_add)
+
+        images = {}
+        for image in self.images_to_add:
+            images[image.id] = image
+            pipeline.submit(image.id, image.upload_filename, image.description)
+        print(f"{self.name}: Uploading media for {len(images)} images.")
+
+        waiting = {image.id : group for group in self.group_images(self.images_to_add) for image in group}
+        uploaded = {}   # id(group) -> members whose media is ready
+        completed = set()
+        failed = []
+        progress_counter = 1
+        progress_end = len(images)
+        for image_id, media, error in pipeline.results():
+            image = images[image_id]
+            group = waiting.pop(image_id)
+            self.release_source(image)
+            if error is not None:
+                logging.error(f"{self.name}: Unable to upload {image.filename}. {error}")
+                self.breaker.record_failure()
+                failed.append(image)
+            else:
+                image.media = media
+                uploaded.setdefault(id(group), []).append(image)
+            if any(member.id in waiting for member in group):
+                continue    # Post once the rest of the group is ready
+            members = sorted(uploaded.pop(id(group), []), key=lambda member: member.date_time)
+            if len(members) == 0:
+                continue
+            if self.breaker.is_open:
+                failed.extend(members)
+                continue
+
+            if len(members) == 1:
+                print(f'{self.name}: {self.describe(members[0])} ({progress_counter}/{progress_end})')
+                if self.attempt(members[0]) is None:
+                    completed.add(members[0])
+                else:
+                    failed.append(members[0])
+            else:
+                print(f'{self.name}: Adding {len(members)} images as one post ({progress_counter}-{progress_counter + len(members) - 1}/{progress_end}) "{members[0].title}" ...')
+                posted = self.post_group(members)
+                completed.update(posted)
+                failed.extend(member for member in members if member not in posted)
+            progress_counter += len(members)
+
+        # Failures are retried one at a time, uploading again where the media never arrived
+        self.images_to_add = completed | self.run_operations(failed, first_attempt=2)
+
+    def post_group(self, images):
+        """Post several images with uploaded media as one status, and update IMatch with the shared
+        status. Returns the images completed. Any others are left to be retried on their own."""
+        for image in images:
+            self.journal.intent(image.id, "add")
+        status = None
+        recorded = []   # Members fully written back to IMatch
+        try:
+            status = self.api.status_post(
+                status = self.group_description(images),
+                media_ids = [image.media for image in images],
+                visibility = self._visibility
+            )
+            attributes = {}
+            for image in images:
+                attributes[image.id] = {
+                    'posted' : status['created_at'].isoformat()[:10],
+                    'media_id' : image.media['id'],
+                    'status_id' : status['id'],
+                    'url' : status['url']
+                    }
+                self.journal.remote(image.id, status['id'], attributes[image.id])
+            for image in images:
+                im.IMatchAPI().set_attributes(self.name, image.id, data = attributes[image.id])
+                self.journal.recorded(image.id)
+                recorded.append(image)
+        except Exception as e:
+            logging.error(f"{self.name}: Posting {len(images)} images together failed. {e}")
+            # If the status went up, record it in IMatch rather than posting it again. Members
+            # already recorded are done and no longer in the journal.
+            incomplete = self.journal.incomplete()
+            posted = list(recorded)
+            for image in images:
+                operation = incomplete.get(image.id)
+                if image not in recorded and operation is not None and operation['step'] == OperationJournal.REMOTE:
+                    self.replay(image.id, operation)
+                    posted.append(image)
+            if status is not None:
+                self.breaker.record_success()   # The platform took the post. The failure was ours.
+            else:
+                self.breaker.record_failure()
+            for image in posted:
+                self.retries.pop(str(image.id), None)
+            return posted
+
+        self.breaker.record_success()
+        for image in images:
+            self.retries.pop(str(image.id), None)
+        return images
+
+    def commit_add(self, image):
+        """Make the api call to commit the image to the platform, and update IMatch with reference details.
+        Media already uploaded and processed is used if there is some, otherwise it is uploaded here."""
+        try:
+            # Prepare the image for attaching to the status. In Mastodon, "posts/toots" are all status
+            # Upload the media, then the status with the media attached. 
+            if image.media is None:
+                image.media = post_media(self.api, image.upload_filename, image.description, True)
+            media = image.media
+
+            # Create a new status with the uploaded image                   
+            status = self.api.status_post(
+                status = image.full_description,
+                media_ids = media, 
+                visibility = self._visibility
+            )
+
+            # Update the image in IMatch by adding the attributes below.
+            attributes = {
+                'posted' : status['created_at'].isoformat()[:10],
+                'media_id' : media['id'],
+                'status_id' : status['id'],
+                'url' : status['url']
+                }
+            self.journal.remote(image.id, status['id'], attributes)
+            im.IMatchAPI().set_attributes(self.name, image.id, data = attributes)
+        except KeyError as e:
+            raise CommitError("Missed validating an image field somewhere.") from e
+        except mastodon.MastodonAPIError as mae:
+            raise CommitError(f"An API error occurred: {mae}.") from mae
+        except Exception as e:
+            raise CommitError(f"An unexpected error occurred: {e}") from e
+
+    def commit_delete(self, image):
+        """Make the api call to delete the image from the platform"""
+        try:
+            attributes = im.IMatchAPI().get_attributes(self.name, image.id)[0]
+            status_id = attributes['status_id']
+
+            members = self.status_members(status_id)
+            others = [media_id for member, media_id in members.items() if member != image.id]
+            if len(others) > 0:
+                # Other images share the post. Take this image off it and leave the post up, with its
+                # text unchanged, so the cached source stays good for the next member removed.
+                status = self.api.status_update(
+                    id = status_id,
+                    status = self.fetch_status_source(status_id)['text'],
+                    media_ids = others,
+                )
+            else:
+                status = self.api.status_delete(
+                    id = status_id,
+                )
+                self.cache.invalidate(status_id)
+            members.pop(image.id, None)
+            self.journal.remote(image.id, status_id)
+        except KeyError as e:
+            raise CommitError("Missed validating an image field somewhere.") from e
+        except mastodon.MastodonNotFoundError:
+            # Already gone from the server, which is what we wanted
+            logging.warning(f"{self.name}: Status {status_id} was already deleted.")
+            self.journal.remote(image.id, status_id)
+            self.cache.invalidate(status_id)
+        except mastodon.MastodonAPIError as mae:
+            raise CommitError(f"An API error occurred: {mae}.") from mae
+        except Exception as e:
+            raise CommitError(f"An unexpected error occurred: {e}") from e
+
+    def pace_delete(self):
+        """Wait for room in the delete rate limit (30 per 30 minutes by default on Mastodon).
+
+        Mastodon.py keeps the rate limit headers from the last response, which after a deletion
+        describe the deletion limit. Deletions are spread over the remaining budget. If the next
+        one could not start within config.DELETE_TIME_BUDGET seconds of the first, the rest are
+        left for the next run."""
+        now = time.time()
+        if self._delete_deadline is None:
+            self._delete_deadline = now + config.DELETE_TIME_BUDGET
+
+        until_reset = max(0, self.api.ratelimit_reset - now)
+        if self.api.ratelimit_remaining <= 0:
+            wait = until_reset
+        else:
+            wait = max(0, until_reset / self.api.ratelimit_remaining - (now - self.api.ratelimit_lastcall))
+
+        if now + wait > self._delete_deadline:
+            return False
+        if wait > 1:
+            print(f"{self.name}: Pacing deletions. Waiting {wait:.0f} seconds ({self.api.ratelimit_remaining} left before the limit resets).")
+        time.sleep(wait)
+        return True
+
+    def plan_calls(self):
+        calls = Counter()
+        calls['media_post'] += len(self.images_to_add)
+        calls['status_post'] += len(self.group_images(self.images_to_add))
+        volume = sum(self.upload_size(image) for image in self.images_to_add)
+        # Grouped statuses keep their text, so status_update is at most one per image
+        calls['media_update'] += len(self.images_to_update)
+        calls['status_update'] += len(self.images_to_update)
+        # A status shared with other images is edited rather than deleted
+        calls['status_delete'] += len(self.images_to_delete)
+        return +calls, volume
+
+    def delete_seconds(self, calls):
+        """Time to make the deletions in calls, spread over the delete rate limit as pace_delete() does"""
+        limit = config.PLAN_DELETE_LIMITS.get(self.name)
+        if limit is None:
+            return 0
+        return calls['status_delete'] * limit['window'] / limit['calls']
+
+    def plan_seconds(self, calls, volume):
+        """As for other platforms, plus paced deletions up to config.DELETE_TIME_BUDGET. The rest
+        are left for later runs."""
+        return super().plan_seconds(calls, volume) + min(self.delete_seconds(calls), config.DELETE_TIME_BUDGET)
+
+    def plan_notes(self, calls, volume):
+        delete_seconds = self.delete_seconds(calls)
+        if delete_seconds <= config.DELETE_TIME_BUDGET:
+            return []
+        runs = -(-delete_seconds // config.DELETE_TIME_BUDGET)
+        return [f"Deletions need about {format_duration(delete_seconds)}, so will be spread over {runs:.0f} runs"]
+
+    def commit_update(self, image):
+        """Make the api call to update the image on the platform"""
+        try:
+            attributes = im.IMatchAPI().get_attributes(self.name, image.id)[0]
+            media_id = attributes['media_id']
+            status_id = attributes['status_id']
+
+            media = self.api.media_update(
+                id = media_id,  
+                description= image.description
+            )
+
+            # Update the status with new text. A status shared with other images keeps its text,
+            # so only this image's description changes.
+            if len(self.status_members(status_id)) <= 1:
+                status = self.api.status_update(
+                    id = status_id,
+                    status = image.full_description,
+                    media_ids = media, 
+                )
+            self.journal.remote(image.id, status_id)
+            self.cache.invalidate(status_id)
+
+        except KeyError as e:
+            raise CommitError("Missed validating an image field somewhere.") from e
+        except mastodon.MastodonAPIError as mae:
+            raise CommitError(f"An API error occurred: {mae}.") from mae
+        except Exception as e:
+            raise CommitError(f"An unexpected error occurred: {e}") from e
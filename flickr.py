@@ -1,16 +1,21 @@
+from collections import Counter
 from datetime import datetime
+from functools import cached_property
 import sys
 import logging
-
-import flickrapi
+import time
 
 from imatch_image import IMatchImage
 import IMatchAPI as im
-from platform_base import PlatformController
+from platform_base import CommitError, PlatformController
 import config
+from source_buffers import sources
+import storage
 
 logging.getLogger("flickrapi.core").setLevel(logging.WARN)  # Hide basic info messages
 
+flickrapi = None    # Imported by connect() so runs with nothing to upload skip the import
+
 
 class FlickrImage(IMatchImage):
 
@@ -19,7 +24,7 @@ class FlickrImage(IMatchImage):
     def __init__(self, id, platform) -> None:
         super().__init__(id, platform)
 
-        if self.size > FlickrImage.__MAX_SIZE:
+        if self.size > FlickrImage.__MAX_SIZE and self.controller.transcode_profile is None:
             logging.warning(f'{self.name}: {self.filename} may be too large to upload: {self.size/config.MB_SIZE:2.1f} MB. Max is {FlickrImage.__MAX_SIZE/config.MB_SIZE:2.1f} MB.')
 
     def prepare_for_upload(self) -> None:
@@ -79,7 +84,7 @@ class FlickrImage(IMatchImage):
                     self.errors.append(f"missing {attribute}")
             except AttributeError:
                 self.errors.append(f"missing {attribute}")
-        if self.size > FlickrImage.__MAX_SIZE:
+        if self.size > FlickrImage.__MAX_SIZE and self.controller.transcode_profile is None:
             self.errors.append(f"file too large")
         return len(self.errors) == 0 and result
 
@@ -88,17 +93,93 @@ class FlickrImage(IMatchImage):
         res = im.IMatchAPI.get_attributes("flickr", self.id)
         return len(res) != 0
     
+class GroupPoolQueue():
+    """Photos waiting to be added to flickr group pools, kept between runs in the local state folder.
+
+    Groups limit how many photos a member may add in a period. Additions are queued per group and
+    drained as each group allows. A throttled group is left alone until its retry time passes."""
+
+    def __init__(self) -> None:
+        self.filename = "flickr_group_queue.json"
+        self.pools = None   # Loaded on first use
+
+    def _load(self):
+        if self.pools is None:
+            self.pools = storage.load_json(self.filename, {})
+
+    def add(self, group_id, photo_id):
+        self._load()
+        pool = self.pools.setdefault(group_id, {'pending' : [], 'retry_after' : 0})
+        if photo_id not in pool['pending']:
+            pool['pending'].append(photo_id)
+            self.save()
+
+    def discard(self, photo_id, keep=[]):
+        """Remove the photo from every group queue except those listed in keep"""
+        self._load()
+        changed = False
+        for group_id, pool in self.pools.items():
+            if group_id not in keep and photo_id in pool['pending']:
+                pool['pending'].remove(photo_id)
+                changed = True
+        if changed:
+            self.save()
+
+    def done(self, group_id, photo_id):
+        self._load()
+        self.pools[group_id]['pending'].remove(photo_id)
+
+    def throttle(self, group_id, seconds):
+        self._load()
+        self.pools[group_id]['retry_after'] = time.time() + seconds
+
+    def due(self):
+        """Return the ids of groups with photos waiting and no throttle in force"""
+        self._load()
+        now = time.time()
+        return [group_id for group_id, pool in self.pools.items() if len(pool['pending']) > 0 and pool['retry_after'] <= now]
+
+    def pending(self, group_id):
+        self._load()
+        return list(self.pools[group_id]['pending'])
+
+    def backlog(self):
+        """Return {group id : (photos waiting, retry after)} for every group with photos waiting"""
+        self._load()
+        return {group_id: (len(pool['pending']), pool['retry_after']) for group_id, pool in self.pools.items() if len(pool['pending']) > 0}
+
+    def save(self):
+        self._load()
+        self.pools = {group_id: pool for group_id, pool in self.pools.items() if len(pool['pending']) > 0}
+        storage.save_json(self.filename, self.pools)
+
 class FlickrController(PlatformController):
 
+    __AUDIT_PAGE_SIZE = 500     # Largest page people.getPhotos allows
+
+    # groups.pools.add error codes. See https://www.flickr.com/services/api/flickr.groups.pools.add.html
+    __POOL_ADDED = [3, 6, 7]        # Already in the pool, or waiting in the group's moderation queue
+    __POOL_THROTTLED = [5, 10]      # Member's photo limit reached, or the pool is full
+    __POOL_REJECTED = [1, 2, 4, 8]  # No such group or photo, photo in too many pools, content not allowed
+
     def __init__(self, platform) -> None:
         super().__init__(platform)
-        self.privacy = {
+        self.upload_format = im.IMatchAPI.FORMAT_JPEG
+        self.group_queue = GroupPoolQueue()
+
+    @cached_property
+    def privacy(self):
+        """Privacy settings for uploads, read from IMatch on first use"""
+        return {
             'is_public' : im.IMatchAPI.get_application_variable("flickr_is_public"),
             'is_family' : im.IMatchAPI.get_application_variable('flickr_is_family'),
             'is_friend' : im.IMatchAPI.get_application_variable('flickr_is_friend')
         }
 
-        self.organisation_categories = {}
+    @cached_property
+    def organisation_categories(self):
+        """Album and group categories keyed by their flickr id, read from IMatch on first use"""
+        organisation_categories = {}
         for category in ['albums', 'groups']:
             category_info = im.IMatchAPI.get_category_info(
                 category = im.IMatchUtility.build_category([
@@ -110,17 +191,19 @@ class FlickrController(PlatformController):
                     'fields' : 'children,name,description'
                 }
             )
-            self.organisation_categories[category] = {}
+            organisation_categories[category] = {}
             for imatch_cat in category_info[0]['children']:
-                self.organisation_categories[category][imatch_cat['description']] = imatch_cat
-
-        self.upload_format = im.IMatchAPI.FORMAT_JPEG
+                organisation_categories[category][imatch_cat['description']] = imatch_cat
+        return organisation_categories
 
     def connect(self):
+        global flickrapi
         if self.api is not None:
             return
         else: 
             try:
+                import flickrapi
+
                 print(f"{self.name}: Work to do -- Connecting to platform.")
                 flickr = flickrapi.FlickrAPI(
                     im.IMatchAPI.get_application_variable("flickr_apikey"),
@@ -141,16 +224,24 @@ class FlickrController(PlatformController):
     def commit_add(self, image):       
         """Make the api call to commit the image to the platform, and update IMatch with reference details"""
         try:
-            response = self.api.upload(
-                image.filename,
-                title = image.title if image.title != '' else image.name,
-                description = image.full_description,
-                is_public = self.privacy['is_public'],
-                is_friend = self.privacy['is_friend'],
-                is_family = self.privacy['is_family'],
-                )
+            with sources.open(image.upload_filename) as file:
+                response = self.api.upload(
+                    image.upload_filename,
+                    fileobj = file,
+                    title = image.title if image.title != '' else image.name,
+                    description = image.full_description,
+                    is_public = self.privacy['is_public'],
+                    is_friend = self.privacy['is_friend'],
+                    is_family = self.privacy['is_family'],
+                    )
             
             photo_id = response.findtext('photoid')
+            attributes = {
+                'posted' : datetime.now().isoformat()[:10],
+                'photo_id' : photo_id,
+                'url' : f"{im.IMatchAPI.get_application_variable("flickr_url")}/{photo_id}"
+                }
+            self.journal.remote(image.id, photo_id, attributes)
             
             # Since we expect no EXIF data in the file, flickr will take the upload time from the last modified date of the file
             # and ignore XMP::EXIF fields. Fix that by setting the time ourselves. The format we have is 
@@ -159,8 +250,9 @@ class FlickrController(PlatformController):
             for album in image.albums:
                 response = self.api.photosets_addPhoto(photoset_id=album, photo_id=photo_id)
 
+            # Groups throttle additions, so these are queued and drained as each group allows
             for group in image.groups:
-                response = self.api.groups_pools_add(group_id=group, photo_id=photo_id)
+                self.group_queue.add(group, photo_id)
 
             # flickr will bring in hierarchical keywords not under our control as level|level|level
             # which frankly is stupid. Easiest way is to delete them all. We don't know quite what
@@ -174,16 +266,10 @@ class FlickrController(PlatformController):
             # Now add back the "Approved" tags. If added on upload, they combine with IPTC weirdly
             resp = self.api.photos.addTags(tags=",".join(image.keywords), photo_id=photo_id)
         except flickrapi.FlickrError as fe:
-                logging.error(fe)
-                sys.exit(1)
+            raise CommitError(fe) from fe
 
         # Update the image in IMatch by adding the attributes below.
-        posted = datetime.now().isoformat()[:10]
-        im.IMatchAPI.set_attributes(self.name, image.id, data = {
-            'posted' : posted,
-            'photo_id' : photo_id,
-            'url' : f"{im.IMatchAPI.get_application_variable("flickr_url")}/{photo_id}"
-            })
+        im.IMatchAPI.set_attributes(self.name, image.id, data = attributes)
                             
     def commit_delete(self, image):
         """Make the api call to delete the image from the platform"""
@@ -191,10 +277,11 @@ class FlickrController(PlatformController):
             attributes = im.IMatchAPI().get_attributes(self.name, image.id)[0]
             photo_id = attributes['photo_id']
             response = self.api.photos.delete(photo_id = photo_id)
+            self.journal.remote(image.id, photo_id)
+            self.cache.invalidate(photo_id)
+            self.group_queue.discard(photo_id)
         except flickrapi.FlickrError as fe:
-            logging.error(fe)
-            logging.error(response)
-            sys.exit(1)
+            raise CommitError(fe) from fe
 
     def commit_update(self, image):
         """Make the api call to update the image on the platform"""
@@ -204,7 +291,9 @@ class FlickrController(PlatformController):
 
             # Some manually added photos don't have a posted date, so pull it down if needed
             if 'posted' not in attributes:
-                response = self.api.photos.getInfo(photo_id = photo_id, format = "parsed-json")
+                response = self.cache.fetch('photos.getInfo', photo_id,
+                    lambda: self.api.photos.getInfo(photo_id = photo_id, format = "parsed-json")
+                    )
                 posted = datetime.fromtimestamp(int(response['photo']['dates']['posted']))
                 im.IMatchAPI.set_attributes(self.name, image.id, data = {
                     'posted' : str(posted)[:10],
@@ -220,10 +309,12 @@ class FlickrController(PlatformController):
 
             if image.operation == IMatchImage.OP_UPDATE:
                 # Update image alongside metadata
-                response = self.api.replace(
-                    filename = image.filename, 
-                    photo_id = photo_id
-                    )
+                with sources.open(image.upload_filename) as file:
+                    response = self.api.replace(
+                        filename = image.upload_filename,
+                        fileobj = file,
+                        photo_id = photo_id
+                        )
 
             response = self.api.photos.setDates(photo_id=photo_id, date_taken=str(image.date_time), date_taken_granularity=0)
             response = self.api.photos.addTags(tags=",".join(image.keywords), photo_id=photo_id)
@@ -232,11 +323,16 @@ class FlickrController(PlatformController):
                 is_public=self.privacy['is_public'],
                 is_friend= self.privacy['is_friend'],
                 is_family = self.privacy['is_family'])
+            # Title, description, dates, tags and permissions have all changed
+            self.cache.invalidate(photo_id, ['photos.getInfo'])
 
-            contexts = self.api.photos.getAllContexts(
-                photo_id = photo_id, 
-                format="parsed-json"
+            contexts = self.cache.fetch('photos.getAllContexts', photo_id,
+                lambda: self.api.photos.getAllContexts(
+                    photo_id = photo_id, 
+                    format="parsed-json"
+                    )
                 )
+            contexts_changed = False
             
             try:
                 for flickr_album in contexts['set']:
@@ -248,6 +344,7 @@ class FlickrController(PlatformController):
                             photoset_id = flickr_album['id'], 
                             photo_id = photo_id
                             )
+                        contexts_changed = True
             except KeyError:
                 # No set information returned so not in any flickr albums
                 pass
@@ -260,12 +357,14 @@ class FlickrController(PlatformController):
                             photoset_id = album,
                             photo_id = photo_id
                             )        
+                        contexts_changed = True
                 else:
                     # No albums set, can go ahead and add
                     response = self.api.photosets_addPhoto(
                         photoset_id = album,
                         photo_id=photo_id
                         )
+                    contexts_changed = True
 
             try:
                 for flickr_group in contexts['pool']:
@@ -277,36 +376,207 @@ class FlickrController(PlatformController):
                             group_id=flickr_group['id'],
                             photo_id=photo_id
                             )
+                        contexts_changed = True
             except KeyError:
                 # No pool information returned so not in any flickr groups
                 pass
 
+            # Groups throttle additions, so new ones wait in the queue. Drop any queued additions
+            # for groups the image has since been taken out of.
+            self.group_queue.discard(photo_id, keep=image.groups)
             for group in image.groups:
                 if "pool" in contexts:
                     match = list(filter(lambda set: set['id'] == group, contexts['pool']))
                     if len(match) == 0:
-                        response = self.api.groups_pools_add(
-                            group_id = group, 
-                            photo_id=photo_id
-                            )        
+                        self.group_queue.add(group, photo_id)
                 else:
                     # No groups set, can go ahead and add
-                    response = self.api.groups_pools_add(
-                        group_id = group, 
-                        photo_id=photo_id
-                        )   
+                    self.group_queue.add(group, photo_id)
+
+            if contexts_changed:
+                # Album and group membership read above is now out of date
+                self.cache.invalidate(photo_id, ['photos.getAllContexts'])
                     
             # Update the image in IMatch by adding the attributes below.
-            posted = datetime.now().isoformat()[:10]
-            im.IMatchAPI.set_attributes(self.name, image.id, data = {
-                'posted' : posted,
+            attributes = {
+                'posted' : datetime.now().isoformat()[:10],
                 'photo_id' : photo_id,
                 'url' : f"{im.IMatchAPI.get_application_variable("flickr_url")}/{photo_id}"
-                })
+                }
+            self.journal.remote(image.id, photo_id, attributes)
+            im.IMatchAPI.set_attributes(self.name, image.id, data = attributes)
             
         except flickrapi.FlickrError as fe:
-            logging.error(fe)
-            logging.error(response)
-            sys.exit(1)
+            raise CommitError(fe) from fe
 
+    def drain_group_queue(self):
+        """Add queued photos to their group pools until each group says to stop"""
+        due = self.group_queue.due()
+        if len(due) == 0:
+            return
+        if self.testing:
+            print(f"{self.name}: **TEST** Adding queued photos to {len(due)} group pools")
+            return
 
+        self.connect()
+        for group_id in due:
+            added = 0
+            for photo_id in self.group_queue.pending(group_id):
+                try:
+                    self.api.groups_pools_add(group_id=group_id, photo_id=photo_id)
+                    added += 1
+                except flickrapi.FlickrError as fe:
+                    try:
+                        code = int(fe.code)
+                    except (AttributeError, TypeError, ValueError):
+                        code = None
+                    if code in FlickrController.__POOL_THROTTLED:
+                        self.group_queue.throttle(group_id, config.FLICKR_GROUP_THROTTLE_RETRY)
+                        print(f"{self.name}: Group {self.group_name(group_id)} is throttling additions. {len(self.group_queue.pending(group_id))} photos left queued.")
+                        break
+                    elif code in FlickrController.__POOL_REJECTED:
+                        logging.warning(f"{self.name}: Photo {photo_id} dropped from the queue for group {self.group_name(group_id)}. {fe}")
+                    elif code not in FlickrController.__POOL_ADDED:
+                        # Unknown trouble. Leave the photo queued and try again next run
+                        logging.error(f"{self.name}: Unable to add photo {photo_id} to group {self.group_name(group_id)}. {fe}")
+                        break
+                self.group_queue.done(group_id, photo_id)
+                self.cache.invalidate(photo_id, ['photos.getAllContexts'])
+            if added > 0:
+                print(f"{self.name}: Added {added} queued photos to group {self.group_name(group_id)}.")
+            self.group_queue.save()
+
+    def group_name(self, group_id):
+        try:
+            return self.organisation_categories['groups'][group_id]['name']
+        except KeyError:
+            return group_id
+
+    def finalise(self):
+        self.drain_group_queue()
+        super().finalise()
+
+    def plan_calls(self):
+        calls = Counter()
+        volume = 0
+        for image in self.images_to_add:
+            calls.update(['upload', 'photos.setDates', 'photos.addTags'])
+            calls['photosets.addPhoto'] += len(image.albums)
+            calls['groups.pools.add'] += len(image.groups)
+            volume += self.upload_size(image)
+        for image in self.images_to_update:
+            calls.update(['photos.setMeta', 'photos.setDates', 'photos.addTags', 'photos.setPerms', 'photos.getAllContexts'])
+            # At most, if the photo is in none of its albums and groups yet
+            calls['photosets.addPhoto'] += len(image.albums)
+            calls['groups.pools.add'] += len(image.groups)
+            if image.operation == IMatchImage.OP_UPDATE:
+                calls['replace'] += 1
+                volume += self.upload_size(image)
+        calls['photos.delete'] += len(self.images_to_delete)
+        # Photos already waiting for their groups
+        calls['groups.pools.add'] += sum(waiting for waiting, retry_after in self.group_queue.backlog().values())
+        return +calls, volume
+
+    def summarise(self):
+        super().summarise()
+        backlog = self.group_queue.backlog()
+        if len(backlog) > 0:
+            print(f"{self.name}: Group pool backlog")
+            for group_id, (waiting, retry_after) in sorted(backlog.items(), key=lambda x: self.group_name(x[0])):
+                if retry_after > time.time():
+                    print(f"-- {waiting} photos waiting for {self.group_name(group_id)} (throttled until {datetime.fromtimestamp(retry_after).strftime('%Y-%m-%d %H:%M')})")
+                else:
+                    print(f"-- {waiting} photos waiting for {self.group_name(group_id)}")
+
+    def fetch_remote_photos(self):
+        """Return every photo on the account keyed by photo id, reading people.getPhotos a page at a time"""
+        photos = {}
+        page = 1
+        pages = 1
+        while page <= pages:
+            response = self.api.people.getPhotos(
+                user_id = 'me',
+                extras = 'date_taken,tags',
+                per_page = FlickrController.__AUDIT_PAGE_SIZE,
+                page = page,
+                format = "parsed-json"
+                )
+            pages = int(response['photos']['pages'])
+            for photo in response['photos']['photo']:
+                photos[photo['id']] = photo
+            print(f"{self.name}: Read page {page}/{pages} of photos on flickr.")
+            page += 1
+        return photos
+
+    def audit(self, queue_drifted=False):
+        """Compare the photo_id and url attributes held in IMatch with the photos actually on flickr.
+
+        Reports photos IMatch knows about that are missing from flickr, flickr photos IMatch has no
+        record of (orphans), and photos whose url, title, date taken or tags have drifted from IMatch.
+        Drifted photos can optionally be queued for a metadata update on the next run."""
+        print( "--------------------------------------------------------------------------------------")
+        print(f"{self.name}: Auditing IMatch records against flickr.")
+        category = im.IMatchAPI.get_categories(im.IMatchUtility.build_category([config.ROOT_CATEGORY, self.name]))
+        catalog_ids = category['directFiles'] if category else []
+        posted = im.IMatchAPI.get_attributed_files(self.name, catalog_ids)
+
+        metadata = {}
+        posted_ids = list(posted.keys())
+        for start in range(0, len(posted_ids), im.IMatchAPI.ATTRIBUTE_BATCH_SIZE):
+            for file in im.IMatchAPI.get_file_metadata(posted_ids[start:start + im.IMatchAPI.ATTRIBUTE_BATCH_SIZE], {
+                "fields" : "id,datetime,name",
+                "tagtitle" : "title",
+                "taghierarchical_keywords" : "hierarchicalkeywords",
+                }):
+                metadata[file['id']] = file
+
+        self.connect()
+        remote_photos = self.fetch_remote_photos()
+        flickr_url = im.IMatchAPI.get_application_variable("flickr_url")
+
+        missing = []
+        drifted = {}
+        for image_id, attributes in posted.items():
+            photo_id = attributes.get('photo_id', '')
+            remote = remote_photos.pop(photo_id, None)
+            if remote is None:
+                missing.append((image_id, photo_id))
+                continue
+
+            file = metadata.get(image_id, {})
+            reasons = []
+            if attributes.get('url') != f"{flickr_url}/{photo_id}":
+                reasons.append("url")
+            if remote['title'].strip() != (file.get('title', '').strip() or file.get('name', '')):
+                reasons.append("title")
+            if remote['datetaken'] != file.get('dateTime', '').replace("T", " "):
+                reasons.append("date taken")
+            if remote['tags'].strip() == '' and len(file.get('hierarchicalkeywords', [])) > 0:
+                reasons.append("tags")
+            if len(reasons) > 0:
+                drifted[image_id] = (photo_id, reasons)
+
+        orphaned = remote_photos    # Anything left on flickr has no IMatch record
+
+        print( "--------------------------------------------------------------------------------------")
+        print(f"{self.name}: Audit of {len(posted)} IMatch records against flickr")
+        print(f"-- {len(missing)} missing from flickr")
+        for image_id, photo_id in missing:
+            print(f"   IMatch file {image_id} records photo {photo_id}")
+        print(f"-- {len(orphaned)} orphaned on flickr")
+        for photo_id, photo in orphaned.items():
+            print(f"   {flickr_url}/{photo_id} \"{photo['title']}\"")
+        print(f"-- {len(drifted)} drifted")
+        for image_id, (photo_id, reasons) in drifted.items():
+            print(f"   IMatch file {image_id}, {flickr_url}/{photo_id}: {', '.join(reasons)}")
+
+        if queue_drifted and len(drifted) > 0:
+            im.IMatchAPI.assign_category(
+                im.IMatchUtility.build_category([
+                    config.ROOT_CATEGORY,
+                    self.name,
+                    config.UPDATE_METADATA_CATEGORY
+                    ]),
+                list(drifted.keys())
+                )
+            print(f"{self.name}: {len(drifted)} drifted images assigned to '{config.ROOT_CATEGORY}|{self.name}|{config.UPDATE_METADATA_CATEGORY}'.")
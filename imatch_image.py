@@ -40,7 +40,11 @@ class IMatchImage():
             "varshutter_speed" : "{File.MD.shutterspeed|value:formatted}",
             "varlatitude" : "{File.MD.gpslatitude|value:rawfrm}",
             "varlongitude" : "{File.MD.gpslongitude|value:rawfrm}",
-            "varcircadatecreated" : "{File.MD.XMP::iptcExt\\CircaDateCreated\\CircaDateCreated\\0}"
+            "varcircadatecreated" : "{File.MD.XMP::iptcExt\\CircaDateCreated\\CircaDateCreated\\0}",
+            "varrights" : "{File.MD.copyright}",
+            "varcountry" : "{File.MD.country}",
+            "varstate" : "{File.MD.state}",
+            "varcity" : "{File.MD.city}",
             }
         
         logging.debug("Querying image parameters")
@@ -82,6 +86,10 @@ class IMatchImage():
                             logging.debug(f'Setting size to {relation['size']}')
                             self.size = relation['size']
 
+        # The file sent to the platform. Controllers may swap in a transcoded derivative.
+        self.upload_filename = self.filename
+        self.source_reserved = False    # Set while held in the shared source buffers
+
         # Set the operation for this file.
         self.operation = IMatchImage.OP_NONE
         if self.is_valid:
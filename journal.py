@@ -0,0 +1,70 @@
+import json
+import os
+import time
+
+import storage
+
+class OperationJournal():
+    """Write-ahead journal of platform operations, so a run that dies part way can be reconciled.
+
+    Every add, update and delete is written in three steps, each flushed to disk before moving on:
+      intent   -- the operation is about to be sent to the platform
+      remote   -- the platform has accepted it (with the remote id and the attributes IMatch needs)
+      recorded -- IMatch has been updated to match
+    or, if the operation is given up on for this run without the platform accepting it,
+      failed   -- nothing was done, and the image is left to be tried again next run
+    An operation that stopped at 'remote' exists on the platform but not in IMatch. The controller
+    replays the IMatch write-back for it at the start of the next run instead of posting it again."""
+
+    INTENT = "intent"
+    REMOTE = "remote"
+    RECORDED = "recorded"
+    FAILED = "failed"
+
+    def __init__(self, platform) -> None:
+        self.filename = storage.state_path(f"{platform}_journal.jsonl")
+
+    def _write(self, entry):
+        entry['time'] = time.time()
+        with open(self.filename, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(entry) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+
+    def intent(self, image_id, op):
+        self._write({'image' : image_id, 'step' : OperationJournal.INTENT, 'op' : op})
+
+    def remote(self, image_id, remote_id, attributes=None):
+        self._write({'image' : image_id, 'step' : OperationJournal.REMOTE, 'remote_id' : remote_id, 'attributes' : attributes})
+
+    def recorded(self, image_id):
+        self._write({'image' : image_id, 'step' : OperationJournal.RECORDED})
+
+    def failed(self, image_id, error):
+        self._write({'image' : image_id, 'step' : OperationJournal.FAILED, 'error' : str(error)})
+
+    def incomplete(self):
+        """Return {image id : operation} for every operation not yet recorded in IMatch. Each
+        operation holds its op, the last step reached and, past 'intent', the remote details."""
+        operations = {}
+        if not os.path.exists(self.filename):
+            return operations
+        with open(self.filename, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue    # A write cut short by the crash itself
+                match entry['step']:
+                    case OperationJournal.INTENT:
+                        operations[entry['image']] = entry
+                    case OperationJournal.REMOTE:
+                        operations.setdefault(entry['image'], {}).update(entry)
+                    case OperationJournal.RECORDED | OperationJournal.FAILED:
+                        operations.pop(entry['image'], None)
+        return operations
+
+    def compact(self):
+        """Rewrite the journal keeping only operations still incomplete"""
+        operations = self.incomplete()
+        storage.atomic_write_text(self.filename, "".join(json.dumps(operation) + "\n" for operation in operations.values()))
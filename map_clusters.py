@@ -0,0 +1,38 @@
+import math
+
+MAX_LATITUDE = 85.05112878     # Web Mercator stops here
+
+def cell(latitude, longitude, cells):
+    """Return the (x, y) Web Mercator grid cell of a point in a world cells wide"""
+    latitude = math.radians(max(-MAX_LATITUDE, min(MAX_LATITUDE, latitude)))
+    x = (longitude + 180.0) / 360.0 * cells
+    y = (1.0 - math.log(math.tan(latitude) + 1.0 / math.cos(latitude)) / math.pi) / 2.0 * cells
+    return (min(int(x), cells - 1), min(int(y), cells - 1))
+
+def cluster(points, zooms, grid):
+    """Group points into clusters for each map zoom level.
+
+    points is {id : (latitude, longitude, date)}. At zoom z the world is split into grid cells per map
+    tile on each side, so clusters stay a similar size on screen at every zoom. Each cluster is
+    [latitude, longitude, count, id], with the centre of its points and the id of its latest point.
+    Returns {zoom : [cluster, ...]} in a stable order."""
+    levels = {}
+    for zoom in zooms:
+        cells = {}
+        for id, (latitude, longitude, date) in points.items():
+            key = cell(latitude, longitude, grid * 2 ** zoom)
+            total = cells.setdefault(key, {'latitude' : 0.0, 'longitude' : 0.0, 'count' : 0, 'latest' : None})
+            total['latitude'] += latitude
+            total['longitude'] += longitude
+            total['count'] += 1
+            if total['latest'] is None or (date, id) > total['latest']:
+                total['latest'] = (date, id)
+        levels[zoom] = [
+            [
+                round(total['latitude'] / total['count'], 5),
+                round(total['longitude'] / total['count'], 5),
+                total['count'],
+                total['latest'][1],
+            ] for key, total in sorted(cells.items())
+        ]
+    return levels
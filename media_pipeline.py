@@ -0,0 +1,86 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import mimetypes
+import os
+import time
+
+import config
+from source_buffers import sources
+
+def post_media(api, media_file, description, synchronous):
+    """Upload a media file from the shared source buffers with api.media_post"""
+    with sources.open(media_file) as file:
+        return api.media_post(
+            media_file = file,
+            mime_type = mimetypes.guess_type(media_file)[0],
+            file_name = os.path.basename(media_file),
+            description = description,
+            synchronous = synchronous
+            )
+
+class MediaPipeline():
+    """Upload media for many images at once and hand each back as soon as the server has processed it.
+
+    Servers using the Mastodon API process large media asynchronously. Uploads and processing polls
+    run on a small pool of threads while results() yields (key, media, error) in the order media
+    becomes ready, so the caller can post each status straight away instead of waiting in turn."""
+
+    __MAX_POLL_INTERVAL = 10    # Seconds between polls once backed off
+
+    def __init__(self, api, workers=config.MEDIA_UPLOAD_WORKERS) -> None:
+        self.api = api
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.uploads = {}       # future -> key
+        self.polls = {}         # future -> (key, deadline, interval)
+        self.processing = {}    # key -> (media, next poll, deadline, interval)
+
+    def submit(self, key, media_file, description):
+        """Start uploading a media file. key identifies it in results()."""
+        future = self.executor.submit(post_media, self.api, media_file, description, False)
+        self.uploads[future] = key
+
+    def _wait_for(self, key, media, deadline, interval):
+        """Queue media the server is still processing for another poll"""
+        interval = min(interval * 1.5, MediaPipeline.__MAX_POLL_INTERVAL)
+        self.processing[key] = (media, time.monotonic() + interval, deadline, interval)
+
+    def results(self):
+        """Yield (key, media, error) for every submitted file as it becomes ready or fails"""
+        try:
+            while len(self.uploads) > 0 or len(self.polls) > 0 or len(self.processing) > 0:
+                futures = list(self.uploads.keys()) + list(self.polls.keys())
+                if len(futures) > 0:
+                    done, _ = wait(futures, timeout=config.MEDIA_POLL_INTERVAL, return_when=FIRST_COMPLETED)
+                else:
+                    # Nothing in flight. Sleep until the next poll is due.
+                    next_poll = min(state[1] for state in self.processing.values())
+                    time.sleep(max(0, next_poll - time.monotonic()))
+                    done = []
+
+                for future in done:
+                    if future in self.uploads:
+                        key = self.uploads.pop(future)
+                        deadline = time.monotonic() + config.MEDIA_PROCESSING_TIMEOUT
+                        interval = config.MEDIA_POLL_INTERVAL / 1.5
+                    else:
+                        key, deadline, interval = self.polls.pop(future)
+                    try:
+                        media = future.result()
+                    except Exception as e:
+                        yield key, None, e
+                        continue
+                    if media['url'] is not None:
+                        yield key, media, None
+                    else:
+                        self._wait_for(key, media, deadline, interval)
+
+                # Poll anything that is due
+                now = time.monotonic()
+                for key, (media, next_poll, deadline, interval) in list(self.processing.items()):
+                    if now > deadline:
+                        del self.processing[key]
+                        yield key, None, TimeoutError(f"media {media['id']} still processing after {config.MEDIA_PROCESSING_TIMEOUT} seconds")
+                    elif next_poll <= now:
+                        del self.processing[key]
+                        self.polls[self.executor.submit(self.api.media, media['id'])] = (key, deadline, interval)
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
@@ -1,25 +1,140 @@
+from functools import cached_property
+import heapq
 import logging
+import time
 
 import IMatchAPI as im
+from circuit_breaker import CircuitBreaker
 from imatch_image import IMatchImage
+from journal import OperationJournal
+from response_cache import ResponseCache
+from source_buffers import sources
+from transcode import Transcoder
 import config
+import storage
 import sys
+
+def format_duration(seconds):
+    """Return a duration as e.g. 2h 05m, 3m 20s or 40s"""
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds}s"
+
+class CommitError(Exception):
+    """A platform operation for one image failed. Raised by commit_* so the image can be retried
+    or left for the next run without stopping the rest."""
+
 class PlatformController():
 
+    __OPERATION_NAMES = {
+        IMatchImage.OP_ADD : "add",
+        IMatchImage.OP_UPDATE : "update",
+        IMatchImage.OP_METADATA : "metadata",
+        IMatchImage.OP_DELETE : "delete",
+    }
+
     def __init__(self, platform) -> None:
         self.images = set()
         self.images_to_add = set()
         self.images_to_delete = set()
         self.images_to_update = set()
         self.invalid_images = set()
+        self.failed_images = set()  # Images whose operation could not be completed this run
         self.api = None  # Holds the platform api connection once active
         self.name = platform
-        self.testing = im.IMatchAPI.get_application_variable("imatch_to_socials_testing") == 1  # = 0 live, 1 = testing
+        self.cache = ResponseCache(platform)  # Read-only platform responses kept between runs
+        self.journal = OperationJournal(platform)
+        self.breaker = CircuitBreaker(platform, config.CIRCUIT_BREAKER_THRESHOLD)
+        self.retries = storage.load_json(f"{platform}_retry.json", {})  # Image id -> operations left over from earlier runs
+        self.catalog_ids = []  # Every image in Socials|{platform}, whether or not it has work to do
+        self.transcode_profile = config.TRANSCODE_PROFILES.get(platform)  # None uploads originals
+        self.uploads_on_update = True   # False if full updates don't send the file again
+
+    @cached_property
+    def testing(self):
+        """Read on first use so runs with nothing to do never ask IMatch"""
+        return im.IMatchAPI.get_application_variable("imatch_to_socials_testing") == 1  # = 0 live, 1 = testing
 
     def connect(self):
         """Upload and add image to platform"""
         raise NotImplementedError("Subclasses must implement this for their specific platform.")
 
+    def action_category(self, action):
+        """Return the path of one of this platform's action categories, e.g. Socials|flickr|_update"""
+        return im.IMatchUtility.build_category([config.ROOT_CATEGORY, self.name, action])
+
+    def recover(self):
+        """Reconcile operations an earlier run left part way through, using the journal.
+
+        An operation the platform accepted but IMatch never heard about has its IMatch write-back
+        replayed, so it is not sent again. Additions also go to the metadata category so any steps
+        after the upload get finished. Operations the platform never confirmed are left to run again."""
+        operations = self.journal.incomplete()
+        if len(operations) == 0:
+            return
+        if self.testing:
+            print(f"{self.name}: **TEST** Reconciling {len(operations)} operations interrupted in an earlier run.")
+            return
+
+        print(f"{self.name}: Reconciling {len(operations)} operations interrupted in an earlier run.")
+        for image_id, operation in operations.items():
+            if operation['step'] == OperationJournal.REMOTE:
+                self.replay(image_id, operation)
+                continue
+            if operation.get('op') == "add":
+                logging.warning(f"{self.name}: Adding image {image_id} was interrupted before {self.name} replied. It will be added again. Check {self.name} for a duplicate.")
+            self.journal.recorded(image_id)
+        self.journal.compact()
+
+    def replay(self, image_id, operation):
+        """Bring IMatch up to date with an operation the platform accepted, from its journal entry"""
+        op = operation['op']
+        if operation['attributes'] is not None:
+            im.IMatchAPI.set_attributes(self.name, image_id, data = operation['attributes'])
+        match op:
+            case "add":
+                im.IMatchAPI.assign_category(self.action_category(config.UPDATE_METADATA_CATEGORY), image_id)
+            case "update":
+                im.IMatchAPI.unassign_category(self.action_category(config.UPDATE_CATEGORY), image_id)
+            case "metadata":
+                im.IMatchAPI.unassign_category(self.action_category(config.UPDATE_METADATA_CATEGORY), image_id)
+            case "delete":
+                im.IMatchAPI.unassign_category(self.action_category(config.DELETE_CATEGORY), image_id)
+                im.IMatchAPI.delete_attributes(self.name, image_id)
+        print(f"{self.name}: Recorded interrupted {op} of image {image_id} ({operation['remote_id']}).")
+        self.journal.recorded(image_id)
+
+    def gather_image_ids(self):
+        """Return the ids of images in Socials|{platform} that may have work to do. Images already on the
+        platform and not waiting in an action or error category are skipped without being loaded."""
+        self.recover()
+
+        root = [config.ROOT_CATEGORY, self.name]
+        category = im.IMatchAPI.get_categories(im.IMatchUtility.build_category(root))
+        if not category:
+            return []   # Category does not exist
+        self.catalog_ids = category['directFiles']
+
+        posted = im.IMatchAPI.get_attributed_files(self.name, self.catalog_ids)
+        candidates = set(self.catalog_ids) - set(posted.keys())
+        for action in [config.UPDATE_CATEGORY, config.UPDATE_METADATA_CATEGORY, config.DELETE_CATEGORY]:
+            action_category = im.IMatchAPI.get_categories(im.IMatchUtility.build_category(root + [action]))
+            if action_category:
+                candidates.update(action_category['directFiles'])
+
+        # Images flagged with errors last run are checked again so fixed images lose their flag
+        for child in im.IMatchAPI.get_categories_children(im.IMatchUtility.build_category(root + [config.ERROR_CATEGORY])):
+            candidates.update(child['files'])
+
+        # Operations that failed last run are tried again. Forget any for images since removed.
+        self.retries = {image_id : retry for image_id, retry in self.retries.items() if int(image_id) in self.catalog_ids}
+        candidates.update(int(image_id) for image_id in self.retries)
+
+        return sorted(candidates.intersection(self.catalog_ids))
+
     def register_image(self, image):
         """Register image to the list of controller's images, and connect to image"""
         image.controller = self
@@ -33,22 +148,150 @@ class PlatformController():
         if not self.testing:        
             self.connect()
 
-        progress_counter = 1
-        progress_end = len(self.images_to_add)
         for image in self.images_to_add:
             image.prepare_for_upload()
+        self.transcode_images(self.images_to_add)
 
-            # Prepare the image for attaching to the status. In Mastodon, "posts/toots" are all status
-            # Upload the media, then the status with the media attached. 
-            if self.testing:
-                print(f'{self.name}: **TEST** Adding {image.filename} ({image.size/config.MB_SIZE:2.1f} MB) ({progress_counter}/{progress_end}) "{image.title}"')
-                progress_counter += 1       
-                continue                            
-            print(f'{self.name}: Adding {image.filename} ({image.size/config.MB_SIZE:2.1f} MB) ({progress_counter}/{progress_end}) "{image.title}"')
+        if self.testing:
+            self.list_operations(self.images_to_add)
+            return
+        self.images_to_add = self.run_operations(self.images_to_add)
 
-            self.commit_add(image)
+    def list_operations(self, images):
+        """Print what would be done in testing mode"""
+        progress_counter = 1
+        progress_end = len(images)
+        for image in images:
+            print(f'{self.name}: **TEST** {self.describe(image)} ({progress_counter}/{progress_end})')
             progress_counter += 1
 
+    def describe(self, image):
+        """One line description of an image's operation for progress output"""
+        match image.operation:
+            case IMatchImage.OP_ADD:
+                return f'Adding {image.filename} ({image.size/config.MB_SIZE:2.1f} MB) "{image.title}"'
+            case IMatchImage.OP_UPDATE:
+                return f'Updating all for {image.filename} ({image.size/config.MB_SIZE:2.1f} MB) "{image.title}"'
+            case IMatchImage.OP_METADATA:
+                return f'Updating metadata for {image.filename} "{image.title}"'
+            case IMatchImage.OP_DELETE:
+                return f'Deleting {image.filename} "{image.title}"  ... {image.name}'
+
+    def run_operations(self, images, first_attempt=1, pace=None):
+        """Perform each image's operation, keeping one image's failure from stopping the rest.
+
+        A failed operation is tried again after config.RETRY_BASE_DELAY seconds, doubling each time,
+        up to config.RETRY_ATTEMPTS attempts. Images still failing, or not reached because the circuit
+        breaker opened, are left for the next run. pace, if given, is called before each attempt and
+        returns False to leave everything remaining for the next run. Returns the images completed."""
+        completed = set()
+        progress_end = len(images)
+        due = 0 if first_attempt == 1 else time.monotonic() + self.retry_delay(first_attempt - 1)
+        pending = [(due, order, image, first_attempt) for order, image in enumerate(images, start=1)]
+        heapq.heapify(pending)
+        while len(pending) > 0:
+            due, order, image, attempt = heapq.heappop(pending)
+            if self.breaker.is_open:
+                self.fail(image, "not attempted, platform unavailable", flag=False)
+                continue
+            time.sleep(max(0, due - time.monotonic()))
+            if pace is not None and not pace():
+                print(f'{self.name}: Rate limit reached. {len(pending) + 1} operations left for the next run.')
+                break
+
+            retry = f" -- retry {attempt - 1} of {config.RETRY_ATTEMPTS - 1}" if attempt > 1 else ""
+            print(f'{self.name}: {self.describe(image)} ({order}/{progress_end}){retry}')
+            error = self.attempt(image)
+            if error is None:
+                completed.add(image)
+            elif attempt < config.RETRY_ATTEMPTS and not self.breaker.is_open:
+                heapq.heappush(pending, (time.monotonic() + self.retry_delay(attempt), order, image, attempt + 1))
+            else:
+                self.fail(image, error)
+        return completed
+
+    def retry_delay(self, attempt):
+        """Seconds to wait before retrying after the given failed attempt"""
+        return config.RETRY_BASE_DELAY * 2 ** (attempt - 1)
+
+    def attempt(self, image):
+        """Perform one image's operation. Returns None once done, otherwise the error.
+
+        If the platform accepted the operation before the error, IMatch is brought up to date from
+        the journal rather than sending it again."""
+        try:
+            self.perform(image)
+        except Exception as e:
+            operation = self.journal.incomplete().get(image.id)
+            if operation is None or operation['step'] != OperationJournal.REMOTE:
+                logging.error(f"{self.name}: {self.describe(image)} failed. {e}")
+                self.breaker.record_failure()
+                return e
+            self.replay(image.id, operation)
+        finally:
+            self.release_source(image)
+        self.breaker.record_success()
+        self.retries.pop(str(image.id), None)
+        return None
+
+    def perform(self, image):
+        """Journal and commit one image's operation, then record it in IMatch"""
+        self.journal.intent(image.id, PlatformController.__OPERATION_NAMES[image.operation])
+        match image.operation:
+            case IMatchImage.OP_ADD:
+                self.commit_add(image)
+            case IMatchImage.OP_UPDATE:
+                self.commit_update(image)
+                im.IMatchAPI.unassign_category(self.action_category(config.UPDATE_CATEGORY), image.id)
+            case IMatchImage.OP_METADATA:
+                self.commit_update(image)
+                im.IMatchAPI.unassign_category(self.action_category(config.UPDATE_METADATA_CATEGORY), image.id)
+            case IMatchImage.OP_DELETE:
+                self.commit_delete(image)
+                # Record each deletion in IMatch as it happens, so an interrupted run picks up where it stopped
+                im.IMatchAPI.unassign_category(self.action_category(config.DELETE_CATEGORY), image.id)
+                im.IMatchAPI.delete_attributes(self.name, image.id)
+        self.journal.recorded(image.id)
+
+    def fail(self, image, error, flag=True):
+        """Leave an image's operation for the next run. flag assigns it to the platform error category."""
+        retry = self.retries.setdefault(str(image.id), {'runs' : 0})
+        retry['op'] = PlatformController.__OPERATION_NAMES[image.operation]
+        retry['runs'] += 1
+        retry['error'] = str(error)
+        self.failed_images.add(image)
+        self.release_source(image)
+        # Close the journal entry, so the next run doesn't take it for one cut short mid-call.
+        # One the platform accepted stays open for recover() to replay.
+        operation = self.journal.incomplete().get(image.id)
+        if operation is not None and operation['step'] == OperationJournal.INTENT:
+            self.journal.failed(image.id, error)
+        if flag:
+            image.errors.append(config.PLATFORM_ERROR)
+
+    def transcode_images(self, images):
+        """Swap upload files for platform-sized derivatives when the platform has a transcode profile,
+        then reserve the files to be sent in the run's shared source buffers. Originals are held while
+        transcoding, so their digest and decode share one read with other platforms."""
+        if self.testing or len(images) == 0:
+            return
+        for image in images:
+            sources.reserve(image.upload_filename)
+            image.source_reserved = True
+        if self.transcode_profile is not None:
+            print(f"{self.name}: Preparing {len(images)} images for upload.")
+            Transcoder(self.transcode_profile).run(images)
+            for image in images:
+                if image.upload_filename != image.filename:
+                    sources.release(image.filename)
+                    sources.reserve(image.upload_filename)
+
+    def release_source(self, image):
+        """Let the shared source buffers drop the image's upload file once this platform is done with it"""
+        if image.source_reserved:
+            sources.release(image.upload_filename)
+            image.source_reserved = False
+
     def classify_images(self):
         for image in self.images:
             match image.operation:
@@ -85,49 +328,96 @@ class PlatformController():
         if not self.testing:
             self.connect()
 
-        deleted_images = set()
-        progress_counter = 1
-        progress_end = len(self.images_to_delete)
-        for image in self.images_to_delete:
-            if self.testing:
-                print(f'{self.name}: **Test** Deleting ({progress_counter}/{progress_end}) "{image.title}"')
-                progress_counter += 1       
-                continue    
-            print(f'{self.name}: Deleting {image.filename} ({progress_counter}/{progress_end}) "{image.title}"  ... {image.name}')
-
-            self.commit_delete(image)
-            deleted_images.add(image.id)
-            progress_counter += 1       
-
-        # Unassign all deleted images from the deleted category
-        im.IMatchAPI.unassign_category(
-            im.IMatchUtility.build_category([
-                config.ROOT_CATEGORY,
-                self.name,
-                config.DELETE_CATEGORY
-                ]), 
-            list(deleted_images)
-            )
-        im.IMatchAPI.delete_attributes(self.name,list(deleted_images))
+        if self.testing:
+            self.list_operations(self.images_to_delete)
+            return
+        # Anything the rate limit leaves stays in the delete category for next time
+        self.images_to_delete = self.run_operations(self.images_to_delete, pace=self.pace_delete)
+
+    def pace_delete(self):
+        """Called before each deletion. Platforms with delete rate limits wait here for room, or
+        return False to leave the remaining deletions for the next run."""
+        return True
 
     def process_errors(self):
         """List information about all images that are invalid and were not processed"""
+        if len(self.images) == 0:
+            return  # Nothing was checked, so nothing in the error categories can have changed
+
         # Clear all images from the error categories before assigning those from this run.
         children = im.IMatchAPI().get_categories_children("|".join([config.ROOT_CATEGORY,self.name,config.ERROR_CATEGORY]))
         for child in children:
             if len(child['files']) > 0:
                 im.IMatchAPI().unassign_category(child['path'], child['files'])
 
-        if len(self.invalid_images) > 0:
+        flagged = self.invalid_images | {image for image in self.failed_images if len(image.errors) > 0}
+        if len(flagged) > 0:
 
             print( "--------------------------------------------------------------------------------------")
             print(f"{self.name}: Images with errors detected and assigned to '{config.ROOT_CATEGORY}|{self.name}' error categories.")
-            for image in sorted(self.invalid_images, key=lambda x: x.name):
+            for image in sorted(flagged, key=lambda x: x.name):
                 for error in image.errors:
                     im.IMatchAPI().assign_category("|".join([config.ROOT_CATEGORY,self.name,config.ERROR_CATEGORY,error]), image.id)
 
     def finalise(self):
         self.process_errors()
+        self.cache.save()
+        self.journal.compact()
+        storage.save_json(f"{self.name}_retry.json", self.retries)
+
+    def plan_calls(self):
+        """Return (Counter of api call : count, bytes sent) for the remote calls commit_add, commit_update
+        and commit_delete would make for the classified images. Calls that depend on what is already on
+        the platform are counted as if needed."""
+        raise NotImplementedError("Subclasses must implement this for their specific platform.")
+
+    def upload_size(self, image):
+        """Bytes sent for an image's file. A transcoded derivative is at most the profile's max_bytes."""
+        if self.transcode_profile is not None:
+            return min(image.size, self.transcode_profile['max_bytes'])
+        return image.size
+
+    def plan_seconds(self, calls, volume):
+        """Project the wall time for calls sending volume bytes. Each call takes config.PLAN_CALL_SECONDS
+        plus its share of the upload, unless the platform's rate limit holds the run back for longer."""
+        total = sum(calls.values())
+        seconds = total * config.PLAN_CALL_SECONDS + volume / config.PLAN_UPLOAD_RATE
+        limit = config.PLAN_RATE_LIMITS.get(self.name)
+        if limit is not None:
+            seconds = max(seconds, total // limit['calls'] * limit['window'])
+        return seconds
+
+    def plan_notes(self, calls, volume):
+        """Extra lines for the plan report, e.g. work a single run can't get through"""
+        return []
+
+    def plan(self):
+        """Report what committing the classified images would cost, without contacting the platform.
+        Returns the totals."""
+        # As add_images() and update_images() would, so plan_calls() sees albums, groups and descriptions
+        for image in self.images_to_add | self.images_to_update:
+            image.prepare_for_upload()
+        calls, volume = self.plan_calls()
+        seconds = self.plan_seconds(calls, volume)
+        metadata = len([image for image in self.images_to_update if image.operation == IMatchImage.OP_METADATA])
+        operations = len(self.images_to_add) + len(self.images_to_update) + len(self.images_to_delete)
+
+        print( "--------------------------------------------------------------------------------------")
+        print(f"{self.name}: Plan for {len(self.images_to_add)} adds, {len(self.images_to_update) - metadata} updates, {metadata} metadata updates and {len(self.images_to_delete)} deletes")
+        print(f"-- {volume/config.MB_SIZE:2.1f} MB to send")
+        print(f"-- {sum(calls.values())} calls" + (": " + ", ".join(f"{count} {call}" for call, count in sorted(calls.items())) if len(calls) > 0 else ""))
+        limit = config.PLAN_RATE_LIMITS.get(self.name)
+        if limit is not None:
+            print(f"-- Rate limit of {limit['calls']} calls every {format_duration(limit['window'])}")
+        print(f"-- About {format_duration(seconds)}")
+        for note in self.plan_notes(calls, volume):
+            print(f"-- {note}")
+        return {
+            "operations" : operations,
+            "bytes" : volume,
+            "calls" : sum(calls.values()),
+            "seconds" : seconds,
+        }
 
     def summarise(self):
         """Output summary of images processed"""
@@ -137,6 +427,13 @@ class PlatformController():
         for val in stats.keys():
             print(f"-- {stats[val]} {val} images")
 
+    def updates_to_prepare(self, images):
+        """The updates that go through transcode_images() first. Only full updates send the file
+        again, and only on platforms that take a new file at all."""
+        if not self.uploads_on_update:
+            return []
+        return [image for image in images if image.operation == IMatchImage.OP_UPDATE]
+
     def update_images(self):
         """Update images already on the platform"""
         if len(self.images_to_update) == 0:
@@ -145,58 +442,28 @@ class PlatformController():
         if not self.testing:
             self.connect()
 
-        progress_counter = 1
-        progress_end = len(self.images_to_update)
         for image in self.images_to_update:
             image.prepare_for_upload()
-            if image.operation == IMatchImage.OP_UPDATE:
-                action = "all"
-            else:
-                action = "metadata"
-        
-            if self.testing:
-                
-                print(f'{self.name}: **TEST** Updating {action} for {image.filename} ({image.size/config.MB_SIZE:2.1f} MB) ({progress_counter}/{progress_end}) "{image.title}"')
-                progress_counter += 1       
-                continue
-            print(f'{self.name}: Updating {action} for {image.filename} ({image.size/config.MB_SIZE:2.1f} MB) ({progress_counter}/{progress_end}) "{image.title}"')
-
-            self.commit_update(image)
-
-            if image.operation == IMatchImage.OP_UPDATE:
-                im.IMatchAPI.unassign_category(
-                    im.IMatchUtility.build_category([
-                        config.ROOT_CATEGORY,
-                        self.name,
-                        config.UPDATE_CATEGORY
-                        ]), 
-                    image.id
-                    )
-
-            if image.operation == IMatchImage.OP_METADATA:
-                im.IMatchAPI.unassign_category(
-                    im.IMatchUtility.build_category([
-                        config.ROOT_CATEGORY,
-                        self.name,
-                        config.UPDATE_METADATA_CATEGORY
-                        ]), 
-                    image.id
-                    )
-                
-
-            progress_counter += 1       
+        self.transcode_images(self.updates_to_prepare(self.images_to_update))
+
+        if self.testing:
+            self.list_operations(self.images_to_update)
+            return
+        self.images_to_update = self.run_operations(self.images_to_update)
 
     @property
     def stats(self):
         return {
-            "total" : len(self.images),
+            "total" : len(self.catalog_ids),
             "added" : len(self.images_to_add),
             "deleted" : len(self.images_to_delete),
             "updated" : len(self.images_to_update),
             "invalid" : len(self.invalid_images),
-            "untouched" : len(self.images)
+            "failed" : len(self.failed_images),
+            "untouched" : len(self.catalog_ids)
                         - len(self.images_to_add)
                         - len(self.images_to_delete)
                         - len(self.images_to_update)
                         - len(self.invalid_images)
+                        - len(self.failed_images)
         }
\ No newline at end of file
@@ -1,20 +1,26 @@
 # pip3 install Mastodon.py
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 import datetime
+import hashlib
 import html
+import json
 import logging
 import os
 import pprint
-import random
 import re
-import subprocess
 import sys
 
-from PIL import Image
-
 from imatch_image import IMatchImage
-from platform_base import PlatformController
+from platform_base import CommitError, PlatformController
 import IMatchAPI as im
 import config
+import map_clusters
+import renditions
+from rendition_cache import RenditionCache
+import storage
+from templates import Template
+import xmp
 
 MASTER_WIDTH = 800
 MASTER_FORMAT = "JPEG"
@@ -27,6 +33,7 @@ class QuantumImage(IMatchImage):
     def __init__(self, id, platform) -> None:
         super().__init__(id, platform)
         self.alt_text = None
+        self.renditions = None  # Rendition specs located in the rendition cache. Set by QuantumController.located_renditions().
 
     def prepare_for_upload(self) -> None:
         """Build variables ready for uploading."""
@@ -68,13 +75,17 @@ class QuantumImage(IMatchImage):
 
 class QuantumController(PlatformController):
 
-    __MAX_SIZE = 25 * config.MB_SIZE
     __PHOTOS_PATH = "photos"
     __ALBUMS_PATH = "albums"
     __PHOTO_TEMPLATE = "photo"
     __MAP_TEMPLATE = "map"
     __ALBUM_TEMPLATE = "album"
     __CARD_TEMPLATE = "card"
+    __ALBUM_INDEX = "quantum_albums.json"
+    __PHOTO_INDEX = "quantum_photos.json"
+    __SITE_INDEX = "index.json"
+    __SITE_MAP = "map.json"
+    __PHOTOS_URL = "https://quantumgardener.info/photos/"
     
     def __init__(self, platform) -> None:
         super().__init__(platform)
@@ -86,34 +97,9 @@ class QuantumController(PlatformController):
             QuantumController.__ALBUM_TEMPLATE : None,
             QuantumController.__CARD_TEMPLATE : None,
         }
-        
-        self.albums = {}
-
-    def classify_images(self):
-        super().classify_images()
-        for image in self.images:
-            for category in image.categories:
-                splits = category['path'].split("|")
-                match splits[0]:
-                    case "Socials":
-                        if splits[1] == "flickr":
-                            # Need to grab any albums and groups
-                            try:
-                                if splits[2] == "albums":
-                                    # Code is in the description
-                                    if splits[3] not in self.albums:
-                                        self.albums[splits[3]] = {}
-                                        self.albums[splits[3]]['name'] = splits[3]
-                                        self.albums[splits[3]]['images'] = set()
-                                        self.albums[splits[3]]['id'] = (category['description'].split("\n"))[0].strip()
-                                        try:
-                                            self.albums[splits[3]]['description'] = (category['description'].split("\n"))[1].strip()
-                                        except IndexError:
-                                            logging.error(f"{self.name}: Text description missing for {category}")
-                                            sys.exit(1)
-                                    self.albums[splits[3]]['images'].add(image)
-                            except IndexError:
-                                pass #no groups or albums found
+        self.rendition_formats = []     # Formats from config.QUANTUM_RENDITION_FORMATS Pillow can write. Set by connect().
+        self.rendition_cache = None     # Set by connect()
+        self.photo_changes = {}         # {media id : photo index entry, or None if deleted} for this run
 
     def prepare_file_information(self, image):
         """Gather information in a consitent format for writing files and add to image"""
@@ -122,7 +108,7 @@ class QuantumController(PlatformController):
             raise ValueError(f'{self.name}: Unable to extract digits from filename')
         image.media_id = match.group(1)
         image.target_master = f'{image.media_id}_{MASTER_WIDTH}.{MASTER_FORMAT.lower()}' 
-        image.target_thumbnail = f'{image.media_id}_{THUMBNAIL_WIDTH}.{THUMBNAIL_FORMAT.lower()}'
+        image.target_thumbnail = self.thumbnail_name(image.media_id)
         image.target_md = os.path.join(self.api[QuantumController.__PHOTOS_PATH], f'{image.media_id}.md')
 
     def write_photo_markdown(self, image):
@@ -133,8 +119,8 @@ class QuantumController(PlatformController):
             'key' : im.IMatchAPI.get_application_variable("quantum_map_key")            
         }
 
-        if not image.is_image_in_category(im.IMatchAPI.get_application_variable("quantum_hide_me")):
-            map = self.templates[QuantumController.__MAP_TEMPLATE].format(**map_values)
+        if not self.is_hidden(image):
+            map = self.templates[QuantumController.__MAP_TEMPLATE].render(**map_values)
             logging.debug("Map included")
         else:
             map = ""
@@ -142,90 +128,163 @@ class QuantumController(PlatformController):
         
 
         template_values = {
-            'aperture' : '{0:.3g}'.format(float(image.aperture)) if image.aperture != "" else "__unknown__",
+            'aperture' : '{0:.3g}'.format(float(image.aperture)) if image.aperture != "" else None,
             'camera' : image.model,
             'date_taken' : image.date_time.strftime('%Y-%m-%dT%H:%M:%S'),
-            'description' : html.unescape(f'{image.headline} {image.description.replace("\n", " ")}'),
-            'focal_length' : image.focal_length if image.focal_length != "" else "__unknown__",
+            'description' : f'{image.headline} {image.description.replace("\n", " ")}',
+            'focal_length' : image.focal_length if image.focal_length != "" else None,
             'image_path' : image.target_master,
-            'iso' : image.iso if image.iso != "" else "__unknown__",
-            'lens' : image.lens if image.lens != "" else "__unknown__",
+            'iso' : image.iso if image.iso != "" else None,
+            'lens' : image.lens if image.lens != "" else None,
             'location' : image.location,
-            'shutter_speed' : image.shutter_speed if image.shutter_speed != "" else "__unknown__",
+            'shutter_speed' : image.shutter_speed if image.shutter_speed != "" else None,
             'title' : image.title,
             'thumbnail' : image.target_thumbnail,
             'map' : map,
+            **self.srcsets(image.media_id, config.QUANTUM_PHOTO_WIDTHS),
         }
 
         if( image.latitude == "" or image.longitude == ""):
             raise ValueError(f"Missing latitude and longitude in image {image.name}")
 
-        # OK to overwrite this every time
-        md_content = self.templates[QuantumController.__PHOTO_TEMPLATE].format(**template_values)
-        ##md_content = html.unescape(md_content)
-        ## Clean out lines with "unknown"
-        lines = md_content.split("\n")
-        filtered_lines = [line for line in lines if "__unknown__" not in line]
-        filtered_markdown = "\n".join(filtered_lines)
-
-        with open(image.target_md, 'w') as file:
-            file.write(filtered_markdown)
-
-    def create_master(self, image):
-        # Resize image
-        with Image.open(image.filename) as img:
-            width, height = img.size
-            aspect_ratio = height / width
-            new_height = int(MASTER_WIDTH * aspect_ratio)
-            img = img.resize((MASTER_WIDTH, new_height), Image.LANCZOS)
-            img.save(self.build_photo_path(image.target_master), format=MASTER_FORMAT, quality=MASTER_QUALITY)
-
-        # Now add back XMP information
-        exiftool = r"C:\Program Files\photools.com\imatch6\exiftool.exe"
-        exiftool = os.path.normpath(exiftool)
-        command = [
-            exiftool,
-            '-TagsFromFile',
-            image.filename,
-            '-xmp:CreateDate',
-            '-xmp-photoshop:DateCreated',
-            '-xmp-dc:Title',
-            '-xmp-dc:Description',
-            '-xmp-xmpRights:All',
-            '-xmp-xmp:Rights',
-            '-xmp-dc:rights',
-            '-XMP-photoshop:Country',
-            '-XMP-photoshop:State',
-            '-XMP-photoshop:City',
-            '-overwrite_original',
-            self.build_photo_path(image.target_master)
-        ]
+        # Lines for details the image doesn't have (None above) are left out
+        md_content = self.templates[QuantumController.__PHOTO_TEMPLATE].render(**template_values)
 
-        try:
-            result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            if result.returncode != 0:
-                logging.error(f"Error copying metadata: {result.stderr}")
-                sys.exit(1)
-            else:
-                logging.debug("Metadata copied successfully.")
-        except FileNotFoundError:
-            logging.error(f"ExifTool not found at {exiftool}")
-            sys.exit(1)
-        except Exception as e:
-            logging.error(f"An error occurred: {e}")
-            sys.exit(1)
+        if not storage.write_text_if_changed(image.target_md, md_content):
+            logging.debug(f"{self.name}: {image.target_md} unchanged")
 
-        if os.path.getsize(self.build_photo_path(image.target_master)) > QuantumController.__MAX_SIZE:
-            self.errors.append(f"file too large")
-            raise ValueError("Image too large after conversion")
+    def is_hidden(self, image):
+        """Images in the quantum_hide_me category don't show where they were taken"""
+        return image.is_image_in_category(im.IMatchAPI.get_application_variable("quantum_hide_me"))
 
-    def create_thumbnail(self, image):
-        with Image.open(image.filename) as img:
-            width, height = img.size
-            aspect_ratio = height / width
-            new_height = int(THUMBNAIL_WIDTH * aspect_ratio)
-            img = img.resize((THUMBNAIL_WIDTH, new_height), Image.LANCZOS)
-            img.save(self.build_photo_path(image.target_thumbnail), format=THUMBNAIL_FORMAT)
+    def photo_entry(self, media_id, title, date_taken, latitude, longitude, hidden):
+        """The photo index entry for a photo. Hidden photos, as on their pages, have no location."""
+        entry = {
+            'title' : html.unescape(title),
+            'date' : date_taken,
+            'thumbnail' : f'{QuantumController.__PHOTOS_URL}{self.thumbnail_name(media_id)}',
+        }
+        if not hidden:
+            try:
+                entry['location'] = [round(float(latitude), 5), round(float(longitude), 5)]
+            except ValueError:
+                pass
+        return entry
+
+    def record_photo(self, image):
+        """Note a written page for the photo index"""
+        self.photo_changes[image.media_id] = self.photo_entry(
+            image.media_id,
+            image.title,
+            image.date_time.strftime('%Y-%m-%dT%H:%M:%S'),
+            image.latitude,
+            image.longitude,
+            self.is_hidden(image)
+            )
+
+    def rendition_specs(self, image):
+        """The files written for an image, in the form renditions.render() takes. The master and
+        thumbnail are always written. The responsive renditions are not made larger than the source."""
+        specs = [
+            {
+                'path' : self.build_photo_path(image.target_master),
+                'width' : MASTER_WIDTH,
+                'format' : MASTER_FORMAT,
+                'options' : {'quality' : MASTER_QUALITY, 'xmp' : xmp.packet(image)},
+                'max_bytes' : config.QUANTUM_MASTER_MAX_BYTES,
+            },
+            {
+                'path' : self.build_photo_path(image.target_thumbnail),
+                'width' : THUMBNAIL_WIDTH,
+                'format' : THUMBNAIL_FORMAT,
+                'max_bytes' : config.QUANTUM_THUMBNAIL_MAX_BYTES,
+            },
+        ]
+        paths = {spec['path'] for spec in specs}
+        for widths in [config.QUANTUM_PHOTO_WIDTHS, config.QUANTUM_THUMBNAIL_WIDTHS]:
+            for format, width, filename in self.ladder(image.media_id, widths):
+                path = self.build_photo_path(filename)
+                if path not in paths:
+                    paths.add(path)
+                    specs.append({
+                        'path' : path,
+                        'width' : width,
+                        'format' : format,
+                        'options' : config.QUANTUM_RENDITION_FORMATS[format],
+                        'upscale' : False,
+                        'max_bytes' : int(config.QUANTUM_MASTER_MAX_BYTES * (width / MASTER_WIDTH) ** 2),
+                    })
+        return specs
+
+    def ladder(self, media_id, widths):
+        """The responsive renditions of a photo at the given widths, as (format, width, filename)"""
+        return [(format, width, f'{media_id}_{width}.{format.lower()}') for format in self.rendition_formats for width in widths]
+
+    def srcsets(self, media_id, widths):
+        """Return the srcset_{format} template fields for the renditions on disk. Formats with none are None."""
+        values = {f'srcset_{format.lower()}' : None for format in config.QUANTUM_RENDITION_FORMATS}
+        for format, width, filename in self.ladder(media_id, widths):
+            if os.path.exists(self.build_photo_path(filename)):
+                field = f'srcset_{format.lower()}'
+                entry = f'{QuantumController.__PHOTOS_URL}{filename} {width}w'
+                values[field] = entry if values[field] is None else f'{values[field]}, {entry}'
+        return values
+
+    def located_renditions(self, image):
+        """The image's rendition specs, located in the rendition cache. Worked out once per run."""
+        if image.renditions is None:
+            image.renditions = self.rendition_cache.locate(image.filename, self.rendition_specs(image))
+        return image.renditions
+
+    def updates_to_prepare(self, images):
+        """Every update is rendered ahead in the pool. Metadata is embedded in the master, so a
+        metadata update needs a new one too."""
+        return list(images)
+
+    def transcode_images(self, images):
+        """Render the renditions missing from the rendition cache for all images in a process pool,
+        ahead of committing them in turn. Images with everything cached need no image work at all."""
+        if self.testing or len(images) == 0:
+            return
+        self.connect()
+
+        pending = {}
+        for image in images:
+            if image.operation == IMatchImage.OP_DELETE:
+                continue
+            try:
+                self.prepare_file_information(image)
+                missing = self.rendition_cache.missing(self.located_renditions(image))
+            except (ValueError, OSError):
+                continue    # Reported when the image is committed
+            if len(missing) > 0:
+                pending[image] = missing
+        if len(pending) == 0:
+            return
+
+        print(f"{self.name}: Rendering {len(pending)} images.")
+        with ProcessPoolExecutor(max_workers=config.RENDITION_WORKERS) as executor:
+            futures = {executor.submit(renditions.render, image.filename, missing): (image, missing) for image, missing in pending.items()}
+            for future, (image, missing) in futures.items():
+                try:
+                    self.rendition_cache.record_skipped(missing, future.result())
+                except Exception as e:
+                    logging.warning(f"{self.name}: Unable to render {image.filename}. It will be tried again on its own. {e}")
+
+    def create_renditions(self, image):
+        """Render whatever the rendition cache is missing for the image, from a single decode of the
+        source and within each rendition's byte budget, then publish the master, thumbnail and responsive renditions from the cache"""
+        specs = self.located_renditions(image)
+        missing = self.rendition_cache.missing(specs)
+        if len(missing) > 0:
+            try:
+                self.rendition_cache.record_skipped(missing, renditions.render(image.filename, missing))
+            except ValueError as e:
+                if "over byte budget" not in image.errors:
+                    image.errors.append(f"over byte budget")
+                # Not a ValueError, so commit_add/commit_update don't swallow it and the image is failed
+                raise CommitError(f"{self.name}: {e}") from e
+        self.rendition_cache.materialize(specs)
 
     def connect(self):
         try:
@@ -241,16 +300,14 @@ class QuantumController(PlatformController):
                 if os.path.exists(self.api[QuantumController.__PHOTOS_PATH]) and os.path.isdir(self.api[QuantumController.__PHOTOS_PATH]):
                     photo_template_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)),'quantum-photo.md')
                     if os.path.exists(photo_template_filename):
-                        with open(photo_template_filename, 'r') as file:
-                            self.templates[QuantumController.__PHOTO_TEMPLATE] = file.read()
+                        self.templates[QuantumController.__PHOTO_TEMPLATE] = Template(photo_template_filename, unescape=['description'])
                     else:
                         logging.error('Connection error: {photo_template_filename} not found.')
                         sys.exit(1)
 
                     map_template_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)),'quantum-photo-map.md')
                     if os.path.exists(map_template_filename):
-                        with open(map_template_filename, 'r') as file:
-                            self.templates[QuantumController.__MAP_TEMPLATE] = file.read()
+                        self.templates[QuantumController.__MAP_TEMPLATE] = Template(map_template_filename)
                     else:
                         logging.error('Connection error: {map_template_filename} not found.')
                         sys.exit(1)
@@ -264,16 +321,14 @@ class QuantumController(PlatformController):
 
                     album_template_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)),'quantum-album.md')
                     if os.path.exists(album_template_filename):
-                        with open(album_template_filename, 'r') as file:
-                            self.templates[QuantumController.__ALBUM_TEMPLATE] = file.read()
+                        self.templates[QuantumController.__ALBUM_TEMPLATE] = Template(album_template_filename, unescape=['title', 'description'])
                     else:
                         logging.error(f'Connection error: {album_template_filename} not found.')
                         sys.exit(1)
                     
                     album_card_template_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)),'quantum-album-card.md')
                     if os.path.exists(album_card_template_filename):
-                        with open(album_card_template_filename, 'r') as file:
-                            self.templates[QuantumController.__CARD_TEMPLATE] = file.read()
+                        self.templates[QuantumController.__CARD_TEMPLATE] = Template(album_card_template_filename, unescape=['title'])
                     else:
                         logging.error(f'Connection error: {album_card_template_filename} not found.')
                         sys.exit(1)
@@ -282,14 +337,87 @@ class QuantumController(PlatformController):
                     logging.error(f'Connection error: {self.api[QuantumController.__ALBUMS_PATH]} not found.')
                     sys.exit(1)
 
+                # Masters carry their metadata in an XMP packet written as they are saved
+                if not renditions.writes_xmp():
+                    logging.error(f'Connection error: Pillow {renditions.XMP_PILLOW_VERSION} or later is needed to write metadata into masters. Please upgrade it (pip3 install -U Pillow).')
+                    sys.exit(1)
+
+                self.rendition_formats = [format for format in config.QUANTUM_RENDITION_FORMATS if renditions.supported(format)]
+                self.rendition_cache = RenditionCache()
                 print(f'{self.name}: Connected to {quantum_path}.')
         except Exception as e:
             print(f"An unknown exception occurred in connnecting: {e}")
             sys.exit(1)
 
 
+    def catalog_photo_index(self):
+        """Build the photo index from every image on quantum with bulk calls, when there is no saved one to update"""
+        posted = im.IMatchAPI.get_attributed_files(self.name, self.catalog_ids)
+        hidden_category = im.IMatchAPI.get_categories(im.IMatchAPI.get_application_variable("quantum_hide_me"))
+        hidden = set(hidden_category['files']) if hidden_category else set()
+
+        index = {}
+        image_ids = sorted(posted)
+        for start in range(0, len(image_ids), im.IMatchAPI.ATTRIBUTE_BATCH_SIZE):
+            for file in im.IMatchAPI.get_file_metadata(image_ids[start:start + im.IMatchAPI.ATTRIBUTE_BATCH_SIZE], {
+                "fields" : "id,datetime",
+                "tagtitle" : "title",
+                "varlatitude" : "{File.MD.gpslatitude|value:rawfrm}",
+                "varlongitude" : "{File.MD.gpslongitude|value:rawfrm}",
+                }):
+                media_id = posted[file['id']]['media_id']
+                index[media_id] = self.photo_entry(media_id, file['title'], file['dateTime'], file['latitude'], file['longitude'], file['id'] in hidden)
+        return index
+
+    def write_photo_index(self):
+        """Bring the photo index up to date with this run's changes and write it, with map clusters
+        built from it, to the photos folder. The site loads these two files instead of every page.
+
+        index.json maps media id to title, date, thumbnail and, unless hidden, location. map.json
+        holds the geotagged photos clustered for each zoom level (see map_clusters.cluster())."""
+        if len(self.images) == 0:
+            return  # No images were gathered, so nothing has changed
+        self.connect()
+
+        index = storage.load_json(QuantumController.__PHOTO_INDEX)
+        if index is None:
+            print(f"{self.name}: Building photo index from the catalog.")
+            index = self.catalog_photo_index()
+        else:
+            for media_id, entry in self.photo_changes.items():
+                if entry is None:
+                    index.pop(media_id, None)
+                else:
+                    index[media_id] = entry
+        storage.save_json(QuantumController.__PHOTO_INDEX, index)
+
+        points = {media_id : (*entry['location'], entry['date']) for media_id, entry in index.items() if 'location' in entry}
+        map_data = {
+            'grid' : config.QUANTUM_MAP_GRID,
+            'zooms' : map_clusters.cluster(points, range(config.QUANTUM_MAP_MAX_ZOOM + 1), config.QUANTUM_MAP_GRID),
+        }
+        for filename, data in [(QuantumController.__SITE_INDEX, index), (QuantumController.__SITE_MAP, map_data)]:
+            if storage.write_text_if_changed(self.build_photo_path(filename), json.dumps(data, separators=(',', ':'), sort_keys=True)):
+                print(f"{self.name}: Wrote {filename}.")
+
+    def plan_calls(self):
+        """Quantum writes files rather than calling an api. Each add and update renders the image,
+        or finds it in the rendition cache, and writes its page. volume is the source files read."""
+        calls = Counter()
+        images = self.images_to_add | self.images_to_update
+        calls['render'] += len(images)
+        calls['write page'] += len(images)
+        calls['remove files'] += len(self.images_to_delete)
+        return +calls, sum(image.size for image in images)
+
+    def plan_seconds(self, calls, volume):
+        return calls['render'] * config.PLAN_RENDER_SECONDS / max(1, config.RENDITION_WORKERS)
+
     def finalise(self):
         self.generate_albums()
+        self.write_photo_index()
+        if self.rendition_cache is not None:
+            self.rendition_cache.prune()
         super().finalise()       
 
     def build_album_path(self, path):
@@ -302,109 +430,167 @@ class QuantumController(PlatformController):
         """Make the api call to commit the image to the platform, and update IMatch with reference details"""
         try:
             self.prepare_file_information(image)
-            
-            if not os.path.exists(self.build_photo_path(image.target_master)):
-                # Add only if not there. We use update flags to replace an existing file
-                self.create_master(image)
-
-            if not os.path.exists(self.build_photo_path(image.target_thumbnail)):
-                self.create_thumbnail(image)
-
+            self.create_renditions(image)
             self.write_photo_markdown(image)
+            self.record_photo(image)
             
             # Update the image in IMatch by adding the attributes below.
-            im.IMatchAPI().set_attributes(self.name, image.id, data = {
+            attributes = {
                 'posted' : datetime.datetime.now().isoformat()[:10],
                 'media_id' : image.media_id,
-                'url' : f'https://quantumgardener.info/photos/{image.media_id}'
-                })
-        except KeyError:
-            logging.error(f"{self.name}: Missed validating an image field somewhere.")
-            sys.exit()
+                'url' : f'{QuantumController.__PHOTOS_URL}{image.media_id}'
+                }
+            self.journal.remote(image.id, image.media_id, attributes)
+            im.IMatchAPI().set_attributes(self.name, image.id, data = attributes)
+        except KeyError as e:
+            raise CommitError("Missed validating an image field somewhere.") from e
         except ValueError:
             pass
-        except Exception as e:
-            logging.error(f"{self.name}: An unexpected error occurred: {e}")
-            sys.exit()
 
     def commit_delete(self, image):
         """Make the api call to delete the image from the platform. We assume the file is not linked anywhere else."""
         try:
             self.prepare_file_information(image)
 
-            if os.path.exists(self.build_photo_path(image.target_master)):
-                os.remove(self.build_photo_path(image.target_master))
-            if os.path.exists(self.build_photo_path(image.target_thumbnail)):
-                os.remove(self.build_photo_path(image.target_thumbnail))
-            if os.path.exists(self.build_photo_path(image.target_md)):
-                os.remove(self.build_photo_path(image.target_md))
+            for path in [spec['path'] for spec in self.rendition_specs(image)] + [image.target_md]:
+                if os.path.exists(path):
+                    os.remove(path)
+            self.photo_changes[image.media_id] = None
+            self.journal.remote(image.id, image.media_id)
 
-        except Exception as e:
-            logging.error(f"{self.name}: An unexpected error occurred: {e}")
-            sys.exit()
+        except OSError as e:
+            raise CommitError(f"Unable to remove files. {e}") from e
 
     def commit_update(self, image):
         """Make the api call to update the image on the platform"""
         try:
             self.prepare_file_information(image)
 
-            if image.operation == IMatchImage.OP_UPDATE:
-                if os.path.exists(self.build_photo_path(image.target_master)):
-                    os.remove(self.build_photo_path(image.target_master))
-                self.create_master(image)
-
-                if os.path.exists(self.build_photo_path(image.target_thumbnail)):
-                    os.remove(self.build_photo_path(image.target_thumbnail))
-                self.create_thumbnail(image)
-
+            self.create_renditions(image)
 
             self.write_photo_markdown(image)
+            self.record_photo(image)
 
             # Update the image in IMatch by adding the attributes below.
-            im.IMatchAPI().set_attributes(self.name, image.id, data = {
+            attributes = {
                 'posted' : datetime.datetime.now().isoformat()[:10],
                 'media_id' : image.media_id,
-                'url' : f'https://quantumgardener.info/photos/{image.media_id}'
-                })
-        except KeyError:
-            logging.error(f"{self.name}: validating an image field somewhere.")
-            sys.exit()
+                'url' : f'{QuantumController.__PHOTOS_URL}{image.media_id}'
+                }
+            self.journal.remote(image.id, image.media_id, attributes)
+            im.IMatchAPI().set_attributes(self.name, image.id, data = attributes)
+        except KeyError as e:
+            raise CommitError("Missed validating an image field somewhere.") from e
         except ValueError:
             pass
-        except Exception as e:
-            logging.error(f"{self.name}: unexpected error occurred: {e}")
-            sys.exit()
     
+    def thumbnail_name(self, media_id):
+        return f'{media_id}_{THUMBNAIL_WIDTH}.{THUMBNAIL_FORMAT.lower()}'
+
+    def album_index(self):
+        """Return {album id : album} for every album in Socials|flickr|albums with images on quantum.
+
+        Built from the whole catalog with bulk calls, so albums are complete however few images this
+        run touched. Each album category's description holds the album id on the first line, its
+        description on the second and, optionally, the media id of a pinned cover on the third."""
+        posted = im.IMatchAPI.get_attributed_files(self.name, self.catalog_ids)
+        albums = {}
+        for category in im.IMatchAPI.get_categories_children(
+                im.IMatchUtility.build_category([config.ROOT_CATEGORY, "flickr", "albums"]),
+                fields = 'children,files,path,description'
+                ):
+            lines = [line.strip() for line in category['description'].split("\n")]
+            if len(lines) < 2:
+                logging.error(f"{self.name}: Text description missing for {category['path']}")
+                continue
+            members = [image_id for image_id in category['files'] if image_id in posted]
+            if len(members) == 0:
+                continue
+            albums[lines[0]] = {
+                'id' : lines[0],
+                'name' : category['path'].split("|")[-1],
+                'description' : lines[1],
+                'pinned' : lines[2] if len(lines) > 2 and lines[2] != '' else None,
+                'members' : members,
+            }
+
+        # Titles and dates for the members of every album
+        info = {}
+        image_ids = sorted({image_id for album in albums.values() for image_id in album['members']})
+        for start in range(0, len(image_ids), im.IMatchAPI.ATTRIBUTE_BATCH_SIZE):
+            for file in im.IMatchAPI.get_file_metadata(image_ids[start:start + im.IMatchAPI.ATTRIBUTE_BATCH_SIZE], {
+                "fields" : "id,datetime",
+                "tagtitle" : "title",
+                }):
+                info[file['id']] = file
+
+        for album in albums.values():
+            album['cards'] = sorted([
+                {
+                    'page' : posted[image_id]['media_id'],
+                    'title' : info[image_id]['title'],
+                    'thumbnail' : self.thumbnail_name(posted[image_id]['media_id']),
+                    'datetime' : info[image_id]['dateTime'],
+                    'srcsets' : self.srcsets(posted[image_id]['media_id'], config.QUANTUM_THUMBNAIL_WIDTHS),
+                } for image_id in album['members']
+                ], key=lambda card: (card['datetime'], card['page']))
+        return albums
+
+    def album_cover(self, album):
+        """Return the card used as an album's cover. A pinned cover is used while it is in the album,
+        otherwise the choice is hash based so it only changes if that image leaves the album."""
+        for card in album['cards']:
+            if card['page'] == album['pinned']:
+                return card
+        return min(album['cards'], key=lambda card: hashlib.sha256(f"{album['id']}:{card['page']}".encode()).hexdigest())
+
     def generate_albums(self):
+        """Write the album pages whose inputs (members, their titles, thumbnails and dates, the album
+        text and the templates) have changed since they were last written"""
+        if len(self.images) == 0:
+            return  # No images were gathered, so no album has changed
         self.connect()
 
-        for album in self.albums.values():
-            print(f"{self.name}: Creating album for {album['name']} [{len(album['images'])} images].")
+        index = storage.load_json(QuantumController.__ALBUM_INDEX, {})
+        albums = self.album_index()
+        for album_id, album in albums.items():
+            cover = self.album_cover(album)
+            digest = hashlib.sha256(json.dumps([
+                album['name'],
+                album['description'],
+                cover['page'],
+                album['cards'],
+                self.templates[QuantumController.__ALBUM_TEMPLATE].source,
+                self.templates[QuantumController.__CARD_TEMPLATE].source,
+                ]).encode()).hexdigest()
+            album_filename = self.build_album_path(f"{album_id}.md")
+            if index.get(album_id) == digest and os.path.exists(album_filename):
+                continue
+
+            print(f"{self.name}: Creating album for {album['name']} [{len(album['cards'])} images].")
             cards = []
-            dates = []
-            for image in album['images']:
-                self.prepare_file_information(image)
-                dates.append(image.date_time)
+            for card in album['cards']:
                 card_template_values = {
-                    'page' : image.media_id,
-                    'title' : image.title,
-                    'thumbnail' : image.target_thumbnail,
+                    'page' : card['page'],
+                    'title' : card['title'],
+                    'thumbnail' : card['thumbnail'],
+                    **card['srcsets'],
                 }
-                card_content = self.templates[QuantumController.__CARD_TEMPLATE].format(**card_template_values)
-                cards.append(card_content)
-        
+                cards.append(self.templates[QuantumController.__CARD_TEMPLATE].render(**card_template_values))
+
             album_template_values = {
-                'datetime' : max(dates).strftime('%Y-%m-%dT%H:%M:%S'),
+                'datetime' : max(card['datetime'] for card in album['cards']),
                 'title' : album['name'],
                 'cards' : "\n".join(cards),
                 'description' : album['description'],
-                'thumbnail' : random.choice(list(album['images'])).target_thumbnail
+                'thumbnail' : cover['thumbnail']
             }
 
-            md_content = self.templates[QuantumController.__ALBUM_TEMPLATE].format(**album_template_values)
-            md_content = html.unescape(md_content)
+            md_content = self.templates[QuantumController.__ALBUM_TEMPLATE].render(**album_template_values)
+
+            if storage.write_text_if_changed(album_filename, md_content):
+                logging.debug(f"{self.name}: Wrote album to {album_filename}")
+            index[album_id] = digest
 
-            album_filename = self.build_album_path(f"{album['id']}.md")
-            logging.debug(f"{self.name}: Writing album to {album_filename}")
-            with open(album_filename, 'w') as file:
-                file.write(md_content)
+        # Forget albums that no longer exist
+        storage.save_json(QuantumController.__ALBUM_INDEX, {album_id : index[album_id] for album_id in albums if album_id in index})
@@ -0,0 +1,92 @@
+import filecmp
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import config
+from source_buffers import sources
+import storage
+
+class RenditionCache():
+    """Content-addressed store of rendered images, kept in the state folder.
+
+    Each rendition is keyed by the digest of its source file and everything that shapes its output:
+    width, format, upscale, byte budget and the save options, including any embedded metadata. A
+    rendition whose key is already in the store is never rendered again. Published files are hard links into the
+    store where the file system allows, copies otherwise, and are only replaced when they differ.
+
+    A rendition skipped for being wider than its source leaves an empty .skipped marker so the
+    source is not decoded again just to find that out."""
+
+    __SKIPPED = ".skipped"
+
+    def __init__(self, folder="renditions") -> None:
+        self.folder = storage.state_path(folder)
+        os.makedirs(self.folder, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def locate(self, source, specs):
+        """Return specs with each 'path' moved into the store and the original kept as 'target'"""
+        digest = sources.digest(source)
+        located = []
+        for spec in specs:
+            options = dict(spec.get('options', {}))
+            packet = options.pop('xmp', b'')
+            settings = json.dumps([spec['width'], spec['format'], spec.get('upscale', True), spec.get('max_bytes'), options], sort_keys=True)
+            key = hashlib.sha256(f"{digest}|{settings}|".encode('utf-8') + packet).hexdigest()
+            located.append({
+                **spec,
+                'target' : spec['path'],
+                'path' : os.path.join(self.folder, f"{key}.{spec['format'].lower()}"),
+            })
+        return located
+
+    def missing(self, specs):
+        """Return the located specs not yet in the store"""
+        missing = [spec for spec in specs if not os.path.exists(spec['path']) and not os.path.exists(spec['path'] + RenditionCache.__SKIPPED)]
+        self.hits += len(specs) - len(missing)
+        self.misses += len(missing)
+        return missing
+
+    def record_skipped(self, specs, written):
+        """Mark the renditions render() chose not to write"""
+        for spec in specs:
+            if spec['path'] not in written:
+                open(spec['path'] + RenditionCache.__SKIPPED, 'w').close()
+
+    def materialize(self, specs):
+        """Publish stored renditions to their targets. Targets of skipped renditions are removed.
+        Returns the number of targets written."""
+        written = 0
+        for spec in specs:
+            if not os.path.exists(spec['path']):
+                if os.path.exists(spec['target']):
+                    os.remove(spec['target'])
+                continue
+            if os.path.exists(spec['target']) and \
+                (os.path.samefile(spec['path'], spec['target']) or filecmp.cmp(spec['path'], spec['target'], shallow=False)):
+                continue
+            storage.atomic_write(spec['target'], lambda temp_path, source=spec['path']: RenditionCache._publish(source, temp_path))
+            written += 1
+        return written
+
+    @staticmethod
+    def _publish(source, temp_path):
+        os.remove(temp_path)    # A hard link needs the name free
+        try:
+            os.link(source, temp_path)
+        except OSError:
+            shutil.copyfile(source, temp_path)    # Another drive, or no hard links
+
+    def prune(self):
+        """Remove renditions no longer published and older than config.RENDITION_CACHE_DAYS. A stored
+        file with other links is still on the site. Copies can't be told apart, so are kept for the age limit."""
+        cutoff = time.time() - config.RENDITION_CACHE_DAYS * 24 * 3600
+        for entry in os.scandir(self.folder):
+            if entry.is_file():
+                stat = os.stat(entry.path)  # DirEntry.stat() has no link count on Windows
+                if stat.st_nlink == 1 and stat.st_mtime < cutoff:
+                    os.remove(entry.path)
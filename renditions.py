@@ -0,0 +1,82 @@
+import io
+
+import storage
+
+DEFAULT_QUALITY = 80
+MIN_QUALITY = 20
+XMP_PILLOW_VERSION = 11     # First Pillow to write the xmp save option to JPEG
+
+def writes_xmp():
+    """Return True if the installed Pillow embeds the xmp save option in JPEGs. Older versions
+    ignore it without complaint."""
+    import PIL
+    return int(PIL.__version__.split(".")[0]) >= XMP_PILLOW_VERSION
+
+def supported(format):
+    """Return True if the installed Pillow can write format"""
+    from PIL import Image
+    Image.init()
+    return format.upper() in Image.SAVE
+
+def encode(img, format, options, max_bytes=None, min_quality=MIN_QUALITY):
+    """Encode img into an in-memory buffer at options['quality'] (DEFAULT_QUALITY if not given).
+    If that is larger than max_bytes, the highest quality down to min_quality that fits is found by
+    bisection. Returns the buffer, or None if even min_quality doesn't fit."""
+    options = dict(options)
+    quality = options.pop('quality', DEFAULT_QUALITY)
+
+    def attempt(quality):
+        buffer = io.BytesIO()
+        img.save(buffer, format=format, quality=quality, **options)
+        return buffer
+
+    best = attempt(quality)
+    if max_bytes is None or best.tell() <= max_bytes:
+        return best
+    best = None
+    low, high = min_quality, quality - 1
+    while low <= high:
+        middle = (low + high) // 2
+        buffer = attempt(middle)
+        if buffer.tell() <= max_bytes:
+            best, low = buffer, middle + 1
+        else:
+            high = middle - 1
+    return best
+
+def render(source, renditions):
+    """Decode source once and write every rendition from it. Returns the paths written.
+
+    renditions is a list of {'path', 'width', 'format', 'options', 'upscale', 'max_bytes'}, where
+    options are passed to Pillow's save. A rendition wider than the source is skipped unless upscale
+    is set. With max_bytes, quality is lowered as far as needed to fit (see encode()) and a
+    rendition that still doesn't fit raises ValueError rather than being written.
+    Renditions are made largest first, each resized from the one before, so the full resolution
+    image is only scaled down once. JPEG sources are decoded straight to the nearest size above the
+    largest rendition. Pillow is imported here so this can run in a worker process."""
+    from PIL import Image
+
+    written = []
+    with Image.open(source) as img:
+        width, height = img.size
+        renditions = sorted(
+            [rendition for rendition in renditions if rendition.get('upscale', True) or rendition['width'] <= width],
+            key=lambda rendition: rendition['width'],
+            reverse=True
+            )
+        if len(renditions) == 0:
+            return written
+        largest = renditions[0]['width']
+        if img.format == "JPEG":
+            img.draft("RGB", (largest, int(largest * height / width)))
+        current = img
+        for rendition in renditions:
+            size = (rendition['width'], int(rendition['width'] * height / width))
+            if current.size != size:
+                current = current.resize(size, Image.LANCZOS, reducing_gap=3.0)
+            buffer = encode(current, rendition['format'], rendition.get('options', {}), rendition.get('max_bytes'))
+            if buffer is None:
+                raise ValueError(f"{rendition['path']} won't fit in {rendition['max_bytes']} bytes")
+            storage.atomic_write_bytes(rendition['path'], buffer.getbuffer())
+            written.append(rendition['path'])
+    return written
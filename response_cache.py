@@ -0,0 +1,83 @@
+import logging
+import time
+
+import config
+import storage
+
+class ResponseCache():
+    """Persistent, size-bounded cache of read-only platform API responses.
+
+    Entries are keyed by API method and the remote id (photo or status) they describe. Each method
+    has its own time to live (config.CACHE_TTL). Anything this tool changes on the platform must be
+    invalidated by the controller so the next read goes back to the platform. The cache is loaded on
+    first use and written back by save()."""
+
+    def __init__(self, platform) -> None:
+        self.filename = f"{platform}_cache.json"
+        self.entries = None     # Loaded on first use
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self):
+        if self.entries is None:
+            self.entries = storage.load_json(self.filename, {})
+
+    @staticmethod
+    def _key(method, id):
+        return f"{method}|{id}"
+
+    def get(self, method, id):
+        """Return the cached response, or None if there isn't a current one"""
+        self._load()
+        key = ResponseCache._key(method, id)
+        entry = self.entries.pop(key, None)
+        if entry is None or entry['expires'] < time.time():
+            if entry is not None:
+                self.dirty = True
+            self.misses += 1
+            return None
+        self.entries[key] = entry   # Re-insert to mark as most recently used
+        self.hits += 1
+        return entry['value']
+
+    def put(self, method, id, value):
+        """Store a response. Methods without a configured TTL are not cached."""
+        ttl = config.CACHE_TTL.get(method)
+        if ttl is None:
+            return
+        self._load()
+        key = ResponseCache._key(method, id)
+        self.entries.pop(key, None)
+        self.entries[key] = {
+            'expires' : time.time() + ttl,
+            'value' : value
+        }
+        while len(self.entries) > config.CACHE_MAX_ENTRIES:
+            del self.entries[next(iter(self.entries))]   # Oldest first
+        self.dirty = True
+
+    def fetch(self, method, id, loader):
+        """Return the cached response for method and id, calling loader() to fill the cache on a miss"""
+        value = self.get(method, id)
+        if value is None:
+            value = loader()
+            self.put(method, id, value)
+        return value
+
+    def invalidate(self, id, methods=None):
+        """Drop cached responses for a remote id. With no methods given, every method is dropped."""
+        self._load()
+        for method in methods if methods is not None else config.CACHE_TTL.keys():
+            if self.entries.pop(ResponseCache._key(method, id), None) is not None:
+                self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        # Expired entries are of no use to the next run
+        now = time.time()
+        self.entries = {key: entry for key, entry in self.entries.items() if entry['expires'] >= now}
+        storage.save_json(self.filename, self.entries)
+        self.dirty = False
+        logging.debug(f"ResponseCache: {self.filename} saved. {self.hits} hits, {self.misses} misses.")
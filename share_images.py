@@ -1,12 +1,15 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 import sys
 import logging
 
 import config
+import fediverse
 import flickr
 import IMatchAPI as im
-import pixelfed
-import my_mastodon
 import quantum
+from platform_base import format_duration
+from source_buffers import sources
 
 logging.basicConfig(
     stream = sys.stdout,
@@ -21,18 +24,16 @@ class Factory():
             'image' : flickr.FlickrImage,
             'controller' : flickr.FlickrController,
         },
-        'pixelfed' : {
-            'image' : pixelfed.PixelfedImage,
-            'controller' : pixelfed.PixelfedController
-        },
-        'mastodon' : {
-            'image' : my_mastodon.MastodonImage,
-            'controller' : my_mastodon.MastodonController
-        },
         'quantum' : {
             'image' : quantum.QuantumImage,
             'controller' : quantum.QuantumController
         },
+        **{
+            instance : {
+                'image' : fediverse.FediverseImage,
+                'controller' : fediverse.FediverseController
+            } for instance in config.FEDIVERSE_INSTANCES
+        },
     }
 
     def __init__(self) -> None:
@@ -51,15 +52,42 @@ class Factory():
         try:
             return cls.platforms[platform]['controller'](platform)
         except KeyError:
-            logging.error(f"{cls.__name__}.build(platform): '{platform.name}' is an unrecognised platform. Valid options are {cls.platforms.keys()}.")
+            logging.error(f"{cls.__name__}.build(platform): '{platform}' is an unrecognised platform. Valid options are {cls.platforms.keys()}.")
             sys.exit()
-          
+
+def gather(controller):
+    """Gather and classify one platform's images"""
+    print( "--------------------------------------------------------------------------------------")
+    print(f"{controller.name}: Gathering images from IMatch.")
+    for image_id in controller.gather_image_ids():
+        image = Factory.build_image(image_id, controller)
+    print(f"{controller.name}: {controller.stats['total']} images gathered from IMatch. {len(controller.images)} to check for action.")
+
+    controller.classify_images()
+
+def process(controller):
+    """Run every phase for one platform"""
+    gather(controller)
+    controller.add_images()
+    controller.update_images()
+    controller.delete_images()
+    controller.finalise()
+
 if __name__ == "__main__":
 
     if not sys.version_info >= (3, 10):
         print(f"Python version 3.10 or later required. You are running with version {sys.version_info.major}.{sys.version_info.minor}")
         sys.exit()
 
+    parser = argparse.ArgumentParser(description="Share images from IMatch to social platforms.")
+    parser.add_argument('platforms', nargs='*', help="Platforms to process. Defaults to all enabled platforms.")
+    parser.add_argument('--audit', action='store_true', help="Compare IMatch records with the platform instead of sharing images.")
+    parser.add_argument('--queue-drifted', action='store_true', help="With --audit, queue drifted images for a metadata update.")
+    parser.add_argument('--plan', action='store_true', help="Report the operations, data, api calls and time a run would take, without making it.")
+    parser.add_argument('--workers', type=int, default=config.RENDITION_WORKERS, help="Processes used to render images for quantum.")
+    args = parser.parse_args()
+    config.RENDITION_WORKERS = args.workers
+
     # Retreive the complete list of Socials files from IMatch for all known
     # platforms. Within IMatch, files are in the Socials|{platform} category
     # or subcategories.
@@ -70,46 +98,77 @@ if __name__ == "__main__":
     im.IMatchAPI()             # Perform initial connection
 
     # Gather all image information for the specified platforms
-    if len(sys.argv[1:]) > 0:
-        for platform in sys.argv[1:]:
+    if len(args.platforms) > 0:
+        for platform in args.platforms:
             platform_controllers.add(Factory.build_controller(platform))
     else:
         # Do the lot
         for platform in Factory.platforms.keys():
-            if platform not in ['mastodon','pixelfed']: ## currently bugged at server end
+            if platform not in config.SKIPPED_BY_DEFAULT:
                 platform_controllers.add(Factory.build_controller(platform))
 
-    for controller in platform_controllers:
+    if args.audit:
+        for controller in platform_controllers:
+            if hasattr(controller, 'audit'):
+                controller.audit(queue_drifted=args.queue_drifted)
+            else:
+                print(f"{controller.name}: Audit is not available for this platform.")
+        print("--------------------------------------------------------------------------------------")
+        print("Done.")
+        sys.exit(0)
+
+    if args.plan:
+        for controller in platform_controllers:
+            controller.testing = True   # Changes nothing, so interrupted operations are only reported
+        gathered = []
+        with ThreadPoolExecutor(max_workers=max(1, len(platform_controllers))) as executor:
+            futures = {executor.submit(gather, controller) : controller for controller in platform_controllers}
+            for future, controller in futures.items():
+                try:
+                    future.result()
+                    gathered.append(controller)
+                except (Exception, SystemExit) as e:
+                    logging.exception(f"{controller.name}: Left out of the plan after an unexpected error. {e!r}")
+        plans = [controller.plan() for controller in gathered]
         print( "--------------------------------------------------------------------------------------")
-        print(f"{controller.name}: Gathering images from IMatch.")
-        try:
-            for image_id in im.IMatchAPI.get_categories(im.IMatchUtility.build_category([config.ROOT_CATEGORY,controller.name]))['directFiles']:
-                image = Factory.build_image(image_id, controller)
-            print(f"{controller.name}: {controller.stats['total']} images gathered from IMatch to action.")
-
-            controller.classify_images()
-            controller.add_images()
-            controller.update_images()
-            controller.delete_images()
-            controller.finalise()
-            controller.summarise()
-        except TypeError: 
-            print(f"{controller.name}: 0 images gathered from IMatch.")
-
-    # stats = {}
-    # for controller in platform_controllers:
-    #     platform_stats = controller.stats
-    #     for stat in platform_stats:
-    #         try:
-    #             stats[stat] += platform_stats[stat]
-    #         except KeyError:
-    #             stats[stat] = platform_stats[stat]
-            
-    # print( "--------------------------------------------------------------------------------------")
-    # print(f"Final summary of images processed")
-    # for val in stats.keys():
-    #     print(f"-- {stats[val]} {val} images")
-    
+        print(f"Plan for {len(plans)} platforms")
+        print(f"-- {sum(plan['operations'] for plan in plans)} operations")
+        print(f"-- {sum(plan['bytes'] for plan in plans)/config.MB_SIZE:2.1f} MB to send")
+        print(f"-- {sum(plan['calls'] for plan in plans)} calls")
+        # Platforms run side by side, so the slowest sets the pace
+        print(f"-- About {format_duration(max([plan['seconds'] for plan in plans], default=0))}")
+        print("--------------------------------------------------------------------------------------")
+        print("Done.")
+        sys.exit(0)
+
+    # Platforms are processed side by side, so quantum's rendering isn't held up waiting on flickr's
+    # network calls. They share one IMatch connection pool, capped at IMatchAPI.MAX_CONCURRENT_REQUESTS.
+    # A platform that fails is reported and leaves the others to finish.
+    with ThreadPoolExecutor(max_workers=max(1, len(platform_controllers))) as executor:
+        futures = {executor.submit(process, controller) : controller for controller in platform_controllers}
+        for future, controller in futures.items():
+            try:
+                future.result()
+            except (Exception, SystemExit) as e:
+                # sys.exit() in a worker, e.g. from a failed connect(), only stops that platform
+                logging.exception(f"{controller.name}: Stopped with an unexpected error. {e!r}")
+
+    stats = {}
+    for controller in platform_controllers:
+        controller.summarise()
+        platform_stats = controller.stats
+        for stat in platform_stats:
+            try:
+                stats[stat] += platform_stats[stat]
+            except KeyError:
+                stats[stat] = platform_stats[stat]
+
+    print( "--------------------------------------------------------------------------------------")
+    print(f"Final summary of images processed across {len(platform_controllers)} platforms")
+    for val in stats.keys():
+        print(f"-- {stats[val]} {val} images")
+    print(f"-- {sources.reads} files read from disk for upload, {sources.shares} uploads shared from memory")
+
     print("--------------------------------------------------------------------------------------")
     print("Done.")
     sys.exit(0)
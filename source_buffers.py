@@ -0,0 +1,107 @@
+from collections import OrderedDict
+import hashlib
+import io
+import os
+import threading
+
+import config
+
+class SourceBuffers():
+    """Upload files read into memory once per run and shared by every platform sending them.
+
+    Platforms reserve the files they are about to upload and release each one once sent. The first
+    open() reads a file from disk, later ones get a read-only view of the same bytes. Files no
+    platform has reserved are dropped, least recently used first, when the buffers would otherwise
+    hold more than max_bytes. A file that still doesn't fit is read from disk as it always was."""
+
+    def __init__(self, max_bytes) -> None:
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.references = {}            # path -> platforms still to send it
+        self.buffers = OrderedDict()    # path -> contents, least recently used first
+        self.loading = {}               # path -> lock held while it is read, so it is only read once
+        self.digests = {}               # path -> sha256 hex digest, worked out once per run
+        self.size = 0                   # Bytes held, or being read into memory
+        self.reads = 0
+        self.shares = 0
+
+    def reserve(self, path):
+        with self.lock:
+            self.references[path] = self.references.get(path, 0) + 1
+
+    def release(self, path):
+        with self.lock:
+            count = self.references.get(path, 0) - 1
+            if count > 0:
+                self.references[path] = count
+            else:
+                self.references.pop(path, None)
+            self._evict()
+
+    def _evict(self, needed=0):
+        """Drop unreserved buffers until needed more bytes fit under the cap. Returns True if
+        they do. Called with the lock held."""
+        for path in list(self.buffers):
+            if self.size + needed <= self.max_bytes:
+                break
+            if path not in self.references:
+                self.size -= len(self.buffers.pop(path))
+        return self.size + needed <= self.max_bytes
+
+    def open(self, path):
+        """Return a binary file object for path, shared from memory where possible. Use it in a
+        with statement so one read from disk is closed."""
+        with self.lock:
+            loading = self.loading.setdefault(path, threading.Lock())
+        with loading:
+            with self.lock:
+                data = self.buffers.get(path)
+                if data is not None:
+                    self.buffers.move_to_end(path)
+                    self.shares += 1
+                    return io.BytesIO(data)
+                size = os.path.getsize(path)
+                fits = self._evict(size)
+                if fits:
+                    self.size += size
+                self.reads += 1
+            if not fits:
+                return open(path, 'rb')
+            try:
+                with open(path, 'rb') as file:
+                    data = file.read()
+            except BaseException:
+                with self.lock:
+                    self.size -= size
+                raise
+            with self.lock:
+                self.size += len(data) - size   # In case it changed since we looked
+                self.buffers[path] = data
+            return io.BytesIO(data)
+
+    def peek(self, path):
+        """Return the contents of path if already in memory, otherwise None. Doesn't read the file."""
+        with self.lock:
+            data = self.buffers.get(path)
+            if data is not None:
+                self.buffers.move_to_end(path)
+                self.shares += 1
+            return data
+
+    def digest(self, path):
+        """Return the sha256 hex digest of a file, read through the buffers once per run whichever
+        platforms ask for it"""
+        with self.lock:
+            digest = self.digests.get(path)
+        if digest is None:
+            hasher = hashlib.sha256()
+            with self.open(path) as file:
+                for block in iter(lambda: file.read(config.MB_SIZE), b''):
+                    hasher.update(block)
+            digest = hasher.hexdigest()
+            with self.lock:
+                self.digests[path] = digest
+        return digest
+
+# Shared by every platform in the run
+sources = SourceBuffers(config.SOURCE_BUFFER_MAX_BYTES)
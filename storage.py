@@ -0,0 +1,86 @@
+import hashlib
+import json
+import logging
+import os
+import stat
+import tempfile
+
+import config
+
+_UMASK = os.umask(0)    # Read once at import. Reading it later would briefly change it for every thread.
+os.umask(_UMASK)
+
+def state_path(name):
+    """Return the full path of a file in the local state folder, creating the folder if needed"""
+    os.makedirs(config.STATE_PATH, exist_ok=True)
+    return os.path.join(config.STATE_PATH, name)
+
+def atomic_write(path, fill):
+    """Replace path with the file fill(temp_path) writes, via a temporary file in the same folder
+    renamed into place, so readers never see a partial file. The new file keeps the old one's mode,
+    or a new file's usual mode, rather than the owner-only mode temporary files are created with."""
+    folder = os.path.dirname(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(dir=folder, prefix=".tmp-")
+    os.close(handle)
+    try:
+        fill(temp_path)
+        try:
+            mode = stat.S_IMODE(os.stat(path).st_mode)
+        except FileNotFoundError:
+            mode = 0o666 & ~_UMASK
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def atomic_write_bytes(path, data):
+    """Atomically write bytes to path"""
+    def fill(temp_path):
+        with open(temp_path, 'wb') as file:
+            file.write(data)
+    atomic_write(path, fill)
+
+def atomic_write_text(path, text):
+    """Atomically write text to path"""
+    def fill(temp_path):
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            file.write(text)
+    atomic_write(path, fill)
+
+def write_text_if_changed(path, text):
+    """Atomically write text to path unless the file already holds exactly that text, so unchanged
+    files keep their modification time. Returns True if the file was written."""
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            if file.read() == text:
+                return False
+    except (OSError, UnicodeDecodeError):
+        pass    # Missing or unreadable, so write it
+    atomic_write_text(path, text)
+    return True
+
+def load_json(name, default=None):
+    """Load a json document from the state folder. Missing or unreadable files return default"""
+    path = state_path(name)
+    if not os.path.exists(path):
+        return default
+    try:
+        with open(path, 'r', encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError) as e:
+        logging.warning(f"storage: Ignoring unreadable state file {path}. {e}")
+        return default
+
+def save_json(name, data):
+    """Save a json document to the state folder"""
+    atomic_write_text(state_path(name), json.dumps(data, indent=1, default=str))
+
+def file_digest(path):
+    """Return the sha256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(config.MB_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
@@ -0,0 +1,54 @@
+import html
+import os
+import string
+
+import config
+
+class Template():
+    """A Markdown template compiled once into lines of literal text and {fields}.
+
+    A line using a field whose value is None, or not given, is left out when rendering, so optional
+    details (lens, ISO, ...) need no placeholder and no second pass. Fields named in unescape have
+    HTML entities decoded as they are inserted. With config.TEMPLATE_RELOAD set, the file is compiled
+    again whenever it changes on disk, for working on templates."""
+
+    def __init__(self, path, unescape=()) -> None:
+        self.path = path
+        self.unescape = set(unescape)
+        self.mtime = None
+        self._compile()
+
+    def _compile(self):
+        with open(self.path, 'r', encoding='utf-8') as file:
+            self.source = file.read()
+        self.mtime = os.path.getmtime(self.path)
+
+        self.lines = []     # Each is (segments, fields on the line). Segments are text or (field, format spec).
+        for line in self.source.split("\n"):
+            segments = []
+            fields = set()
+            for text, field, spec, conversion in string.Formatter().parse(line):
+                if text != '':
+                    segments.append(text)
+                if field is not None:
+                    segments.append((field, spec))
+                    fields.add(field)
+            self.lines.append((segments, fields))
+
+    def render(self, **values):
+        if config.TEMPLATE_RELOAD and os.path.getmtime(self.path) != self.mtime:
+            self._compile()
+
+        for field in self.unescape:
+            if values.get(field) is not None:
+                values[field] = html.unescape(values[field])
+
+        output = []
+        for segments, fields in self.lines:
+            if any(values.get(field) is None for field in fields):
+                continue
+            output.append("".join(
+                segment if isinstance(segment, str) else format(values[segment[0]], segment[1])
+                for segment in segments
+                ))
+        return "\n".join(output)
@@ -0,0 +1,91 @@
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import io
+import json
+import logging
+import os
+import time
+
+import config
+import renditions
+from source_buffers import sources
+import storage
+
+MIN_QUALITY = 60
+
+def transcode(source, target, profile):
+    """Render a derivative of source, a path or the file's contents, that fits the profile's max
+    dimension, byte budget and format.
+
+    Runs in a worker process, so Pillow is imported here. Quality is searched down to MIN_QUALITY
+    first, then the image is shrunk, until the encoded file fits. Returns the size of the file written."""
+    from PIL import Image, ImageOps
+
+    if isinstance(source, bytes):
+        source = io.BytesIO(source)
+    with Image.open(source) as img:
+        max_dimension = profile['max_dimension']
+        if img.format == "JPEG":
+            img.draft("RGB", (max_dimension, max_dimension))    # Let the decoder skip detail we will throw away
+        icc_profile = img.info.get('icc_profile')
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        img.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+
+        while True:
+            buffer = renditions.encode(img, profile['format'], {'quality' : profile['quality'], 'icc_profile' : icc_profile}, profile['max_bytes'], MIN_QUALITY)
+            if buffer is not None:
+                storage.atomic_write_bytes(target, buffer.getbuffer())
+                return buffer.tell()
+            img = img.resize((int(img.width * 0.8), int(img.height * 0.8)), Image.LANCZOS)
+
+class Transcoder():
+    """Render platform-tuned derivatives of upload files before they are sent.
+
+    Derivatives are cached on disk keyed by the source digest and the profile, so an unchanged
+    image is only transcoded once. Rendering runs in a process pool across all pending images."""
+
+    def __init__(self, profile) -> None:
+        self.profile = profile
+        self.folder = storage.state_path("transcode")
+        os.makedirs(self.folder, exist_ok=True)
+
+    def derivative_path(self, source):
+        key = hashlib.sha256((sources.digest(source) + json.dumps(self.profile, sort_keys=True)).encode()).hexdigest()
+        return os.path.join(self.folder, f"{key}.{self.profile['format'].lower()}")
+
+    def run(self, images):
+        """Point each image's upload_filename at a derivative, rendering any not already cached"""
+        pending = {}
+        for image in images:
+            image.derivative = self.derivative_path(image.filename)
+            if os.path.exists(image.derivative):
+                os.utime(image.derivative)  # Keep it from being pruned
+            else:
+                pending[image.derivative] = image
+
+        if len(pending) > 0:
+            with ProcessPoolExecutor(max_workers=config.TRANSCODE_WORKERS) as executor:
+                # Sources still in the shared buffers from working out their digest aren't read again
+                futures = {executor.submit(transcode, sources.peek(image.filename) or image.filename, target, self.profile): image for target, image in pending.items()}
+                for future, image in futures.items():
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logging.error(f"Transcoder: Unable to transcode {image.filename}, uploading the original. {e}")
+                        image.derivative = None
+
+        for image in images:
+            if image.derivative is not None:
+                image.upload_filename = image.derivative
+                image.size = os.path.getsize(image.derivative)
+
+        self.prune()
+
+    def prune(self):
+        """Remove derivatives not used for config.TRANSCODE_CACHE_DAYS"""
+        cutoff = time.time() - config.TRANSCODE_CACHE_DAYS * 24 * 3600
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
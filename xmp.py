@@ -0,0 +1,46 @@
+from xml.sax.saxutils import escape
+
+def _alt(tag, value):
+    return f'<{tag}><rdf:Alt><rdf:li xml:lang="x-default">{escape(value)}</rdf:li></rdf:Alt></{tag}>'
+
+def _simple(tag, value):
+    return f'<{tag}>{escape(value)}</{tag}>'
+
+def packet(image):
+    """Build an XMP packet carrying an image's dates, title, description, rights and location.
+
+    Everything comes from what IMatch already returned for the image, so the packet can be written
+    by Pillow as the file is saved. Empty fields are left out."""
+    date_created = image.date_time.strftime('%Y-%m-%dT%H:%M:%S')
+    properties = [
+        _simple('xmp:CreateDate', date_created),
+        _simple('photoshop:DateCreated', date_created),
+    ]
+    for tag, value, build in [
+        ('dc:title', image.title, _alt),
+        ('dc:description', image.description, _alt),
+        ('dc:rights', image.rights, _alt),
+        ('photoshop:Country', image.country, _simple),
+        ('photoshop:State', image.state, _simple),
+        ('photoshop:City', image.city, _simple),
+        ]:
+        if value.strip() != '':
+            properties.append(build(tag, value))
+    if image.rights.strip() != '':
+        properties.append(_simple('xmpRights:Marked', 'True'))
+
+    return (
+        '<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>'
+        '<x:xmpmeta xmlns:x="adobe:ns:meta/">'
+        '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+        '<rdf:Description rdf:about=""'
+        ' xmlns:dc="http://purl.org/dc/elements/1.1/"'
+        ' xmlns:photoshop="http://ns.adobe.com/photoshop/1.0/"'
+        ' xmlns:xmp="http://ns.adobe.com/xap/1.0/"'
+        ' xmlns:xmpRights="http://ns.adobe.com/xap/1.0/rights/">'
+        + "".join(properties) +
+        '</rdf:Description>'
+        '</rdf:RDF>'
+        '</x:xmpmeta>'
+        '<?xpacket end="w"?>'
+        ).encode('utf-8')